@@ -1,20 +1,135 @@
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, request, render_template_string, jsonify, Response, stream_with_context
+from markupsafe import Markup
 import pandas as pd
+import numpy as np
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
 import os
+import io
+import csv
+import json
+import fcntl
+import threading
 import unicodedata
-from urllib.parse import unquote
+from contextlib import contextmanager
+from urllib.parse import unquote, urlencode
 import shutil
-from datetime import datetime
+import math
+import bisect
+import re
+import uuid
+import time
+import heapq
+import hashlib
+import gzip
+import itertools
+import queue
+import sqlite3
+from collections import OrderedDict
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
 EXCEL_FILE = "bouquets.xlsx"
 SHEET_NAME = "CRM"
+LOCK_FILE = EXCEL_FILE + ".lock"
+JOURNAL_FILE = "journal.ndjson"
+LOTS_FILE = "lots.json"
+
+# филиалы: общие рецепты из EXCEL_FILE, у каждого филиала свой файл склада
+MAIN_BRANCH = "основной"
+BRANCHES_DIR = "branches"
+
+# сколько дней цветок стоит в вазе, если при приёмке не указано
+DEFAULT_VASE_LIFE_DAYS = 7
+
+# сколько ошибок по строкам возвращать при массовом импорте
+MAX_BULK_ERRORS = 500
+
+# больше этого Excel не хранит целые точно (double), такие количества в редакторе отклоняются
+EXCEL_MAX_INT = 2 ** 53
+
+# сколько последних результатов /check держать в памяти
+CHECK_CACHE_SIZE = 1024
+
+# сколько отрендеренных строк заказов главной страницы держать в памяти
+ORDER_ROW_CACHE_SIZE = 5000
+
+# API каталога: размер страницы по умолчанию и максимум
+CATALOG_PAGE_DEFAULT = 100
+CATALOG_PAGE_MAX = 1000
+
+# сколько похожих букетов предлагать вместо несобираемого (по умолчанию и максимум)
+RECOMMEND_DEFAULT = 5
+RECOMMEND_MAX = 50
+
+# JSON-ответы больше этого размера сжимаются (br, если есть модуль brotli, иначе gzip)
+COMPRESS_MIN_BYTES = 1024
+
+# сколько заказов можно прогнать через /simulate за один запрос
+MAX_SIMULATED_ORDERS = 200000
+
+# архив: завершённые и отменённые заказы старше ARCHIVE_AFTER_DAYS уходят из памяти
+# в сжатые колоночные файлы ARCHIVE_DIR/ГГГГ-ММ/*.npz
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_STATUSES = ("оплачен, собран", "отменен, не собран", "отменен, собран")
+
+# фоновые задачи Excel: сколько выполнять одновременно и сколько завершённых хранить;
+# состояние задач — файлы в JOBS_DIR, общие для всех воркеров
+JOB_WORKERS = 1
+MAX_FINISHED_JOBS = 100
+JOBS_DIR = "jobs"
+
+# повторы бронирований (заголовок Idempotency-Key): ответы хранятся в sqlite, общей
+# для воркеров; ключ живёт IDEMPOTENCY_TTL_SECONDS, всего ключей не больше IDEMPOTENCY_MAX_KEYS.
+# Запрос «в работе» дольше IDEMPOTENCY_PENDING_SECONDS считается оборванным
+IDEMPOTENCY_DB = "idempotency.sqlite3"
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_MAX_KEYS = 10000
+IDEMPOTENCY_PENDING_SECONDS = 120
+
+# допуск тяжёлых запросов (редактор Excel, массовый импорт/экспорт, отчёты): одновременно
+# не больше HEAVY_SLOTS на все воркеры, ещё HEAVY_QUEUE ждут до HEAVY_WAIT_SECONDS, остальным — 503.
+# Ожидающий запрос тоже занимает воркер, поэтому HEAVY_SLOTS + HEAVY_QUEUE держат меньше
+# числа воркеров — /check и бронированиям всегда остаётся свободный
+ADMISSION_DIR = "admission"
+HEAVY_SLOTS = int(os.environ.get("HEAVY_SLOTS", "1"))
+HEAVY_QUEUE = int(os.environ.get("HEAVY_QUEUE", "1"))
+HEAVY_WAIT_SECONDS = 3
+HEAVY_RETRY_AFTER_SECONDS = 5
 
 
 orders = []
 next_order_id = 1
 
+# бронь без оплаты снимается автоматически через столько минут (0 — бессрочно)
+RESERVATION_TTL_MINUTES = int(os.environ.get("RESERVATION_TTL_MINUTES", "0"))
+
+# календарь остатков для предзаказов: шаг и горизонт
+PROJECTION_BUCKET_MINUTES = 60
+PROJECTION_HORIZON_DAYS = 14
+
+# предзаказ, который не удалось списать в момент выдачи, пробуем снова через столько минут
+PICKUP_RETRY_MINUTES = 15
+
+# статусы, при которых цветы заказа считаются израсходованными
+CONSUMING_STATUSES = ("забронировано", "оплачен, собран", "оплачен, не собран")
+ORDER_STATUSES = CONSUMING_STATUSES + ("отменен, не собран", "отменен, собран")
+# букет собран — цветы на склад уже не вернутся, списанные партии можно забыть
+SETTLED_STATUSES = ("оплачен, собран", "отменен, собран")
+
+# прогноз спроса
+FORECAST_ALPHA = 0.3
+SEASON_WEEKS = 8
+
 
 def norm(s):
     
@@ -28,19 +143,71 @@ def norm(s):
     s = ' '.join(s.split())
     return s.lower()
 
-def load_data():
-    
-    if not os.path.exists(EXCEL_FILE):
-        return {}, {}
-
-    df = pd.read_excel(EXCEL_FILE, sheet_name=SHEET_NAME, engine="openpyxl", dtype=object)
+def norm_series(s):
+    # norm() для целого столбца строковыми операциями pandas
+    s = s.fillna("").astype(str).str.replace('\xa0', ' ').str.strip()
+    s = s.str.normalize('NFKC').str.replace('ё', 'е').str.replace('Ё', 'Е')
+    return s.str.split().str.join(' ').str.lower()
+
+class FlowerRegistry:
+    # цветы книги: колонки заголовка и плотные целые id по порядку колонок;
+    # ввод пользователя приводится к колонке через norm()
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.exact = {}
+        self.normed = {}
+        for i, name in enumerate(self.names):
+            self.exact.setdefault(name, i)
+            self.normed.setdefault(norm(name), i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def id(self, name):
+        i = self.exact.get(name)
+        return self.normed.get(norm(name)) if i is None else i
+
+    def canonical(self, name):
+        i = self.id(name)
+        return None if i is None else self.names[i]
+
+    def resolve(self, comp):
+        # состав с названиями колонок; варианты написания одного цветка складываются
+        result = {}
+        unknown = []
+        for f, q in comp.items():
+            col = self.canonical(f)
+            if col is None:
+                unknown.append(str(f))
+            else:
+                result[col] = result.get(col, 0) + q
+        return result, unknown
+
+    def vector(self, comp):
+        v = np.zeros(len(self.names), dtype=np.int64)
+        for f, q in comp.items():
+            i = self.id(f)
+            if i is not None:
+                v[i] += int(q)
+        return v
+
+
+def read_data(path=None):
+    # (букеты, склад, реестр цветов)
+    path = path or EXCEL_FILE
+    if not os.path.exists(path):
+        return {}, {}, FlowerRegistry(())
+
+    df = pd.read_excel(path, sheet_name=SHEET_NAME, engine="openpyxl", dtype=object)
 
     cols = list(df.columns)
     if len(cols) < 2:
-        return {}, {}
+        return {}, {}, FlowerRegistry(())
 
     name_col = cols[0]
     flower_cols = cols[1:]
+    registry = FlowerRegistry(str(c) for c in flower_cols)
 
     
     mask = df[name_col].astype(str).fillna('').map(lambda x: norm(x) == 'склад')
@@ -51,7 +218,7 @@ def load_data():
         sklad_rows = df[mask2].index
         if len(sklad_rows) == 0:
             
-            return {}, {}
+            return {}, {}, registry
     sklad_row = sklad_rows[0]
 
     
@@ -88,14 +255,130 @@ def load_data():
             except:
                 pass
 
-    return bouquets, inventory
+    return bouquets, inventory, registry
+
+# --------- кэш разобранной книги ----------
+# версия склада берётся из stat файла: запись идёт через os.replace, поэтому меняются
+# inode и mtime — правки из других воркеров тоже видны. Одновременные разборы одной
+# версии склеиваются в один (single-flight)
+
+def stock_version(path=None):
+    path = path or EXCEL_FILE
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+class SingleFlightCache:
+
+    def __init__(self, load):
+        self.load = load
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.flights = {}
+
+    def get(self, path, version):
+        key = (path, version)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = {"done": threading.Event()}
+        if not leader:
+            flight["done"].wait()
+            if "error" in flight:
+                raise flight["error"]
+            return flight["value"]
+        try:
+            value = flight["value"] = self.load(path)
+            with self.lock:
+                self.entries[path] = (version, value)
+            return value
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight["done"].set()
+
+
+class LRUCache:
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+data_cache = SingleFlightCache(read_data)
+
+
+def load_data(path=None):
+    # книга из кэша по текущей версии файла; словари копируются, вызывающие их меняют
+    path = path or EXCEL_FILE
+    bouquets, inventory, _ = data_cache.get(path, stock_version(path))
+    return dict(bouquets), dict(inventory)
+
+
+def flower_registry(path=None):
+    # реестр разбирается вместе с книгой и живёт в том же кэше
+    path = path or EXCEL_FILE
+    return data_cache.get(path, stock_version(path))[2]
+
+_excel_rlock = threading.RLock()
+_excel_lock_state = threading.local()
+
+
+@contextmanager
+def excel_lock():
+    # блокировка на весь цикл чтение-изменение-запись; межпроцессная (воркеры gunicorn)
+    # и реентерабельная внутри одного потока
+    with _excel_rlock:
+        depth = getattr(_excel_lock_state, "depth", 0)
+        if depth:
+            _excel_lock_state.depth = depth + 1
+            try:
+                yield
+            finally:
+                _excel_lock_state.depth -= 1
+            return
+        with open(LOCK_FILE, "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            _excel_lock_state.depth = 1
+            try:
+                yield
+            finally:
+                _excel_lock_state.depth = 0
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
 
-def save_inventory(inventory):
+def read_frame(path=None):
     
-    if not os.path.exists(EXCEL_FILE):
+    path = path or EXCEL_FILE
+    if not os.path.exists(path):
         raise FileNotFoundError("Excel файл не найден")
 
-    df = pd.read_excel(EXCEL_FILE, sheet_name=SHEET_NAME, engine="openpyxl", dtype=object)
+    df = pd.read_excel(path, sheet_name=SHEET_NAME, engine="openpyxl", dtype=object)
     cols = list(df.columns)
     if len(cols) < 2:
         raise ValueError("Неправильный формат Excel: мало колонок")
@@ -110,16 +393,219 @@ def save_inventory(inventory):
         sklad_rows = df[mask2].index
         if len(sklad_rows) == 0:
             raise ValueError("Не найдена строка 'склад' при сохранении")
-    sklad_row = sklad_rows[0]
-
+    return df, name_col, flower_cols, sklad_rows[0]
+
+
+def write_frame(df, path=None):
+    # пишем во временный файл и подменяем, чтобы читатели не увидели полузаписанный xlsx
+    path = path or EXCEL_FILE
+    tmp = f"{path}.{os.getpid()}.tmp.xlsx"
+    df.to_excel(tmp, sheet_name=SHEET_NAME, index=False, engine="openpyxl")
+    os.replace(tmp, path)
+
+
+# --------- партии (лоты) на складе ----------
+
+class LotStore:
+    # по каждому цветку — min-куча партий [получено, seq, кол-во, годен_до];
+    # итог по цветку хранится отдельно, строка «склад» в Excel остаётся главным источником.
+    # held: что списано под заказ (ключ — lot_key) — при возврате партии восстанавливаются
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.seq = 0
+        self.lots = {}
+        self.held = {}
+        self.totals = {}
+
+    def _reload(self):
+        mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        self.seq, self.lots, self.held, self.totals = 0, {}, {}, {}
+        if mtime is None:
+            return
+        with open(self.path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        self.seq = data.get("seq", 0)
+        self.lots = data.get("lots", {})
+        self.held = data.get("held", {})
+        self.totals = {f: sum(lot[2] for lot in heap) for f, heap in self.lots.items()}
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"seq": self.seq, "lots": self.lots, "held": self.held}, fh, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self.mtime = os.path.getmtime(self.path)
+
+    def _add(self, flower, qty, vase_life):
+        today = datetime.now().date()
+        self.seq += 1
+        lot = [today.isoformat(), self.seq, qty, (today + timedelta(days=vase_life)).isoformat()]
+        heapq.heappush(self.lots.setdefault(flower, []), lot)
+        self.totals[flower] = self.totals.get(flower, 0) + qty
+
+    def _consume(self, flower, qty):
+        # FIFO: сначала самые старые партии; возвращает взятые куски партий
+        heap = self.lots.get(flower, [])
+        taken = []
+        while qty > 0 and heap:
+            lot = heap[0]
+            take = min(lot[2], qty)
+            lot[2] -= take
+            qty -= take
+            self.totals[flower] -= take
+            taken.append([lot[0], lot[1], take, lot[3]])
+            if lot[2] == 0:
+                heapq.heappop(heap)
+        return taken
+
+    def _restore(self, key, flower, qty):
+        # возврат по заказу: последние взятые куски кладутся обратно со своими датами
+        pieces = self.held.get(key, {}).get(flower, [])
+        while qty > 0 and pieces:
+            piece = pieces[-1]
+            back = min(piece[2], qty)
+            piece[2] -= back
+            qty -= back
+            if piece[2] == 0:
+                pieces.pop()
+            heap = self.lots.setdefault(flower, [])
+            lot = next((lot for lot in heap if lot[1] == piece[1]), None)
+            if lot is not None:
+                lot[2] += back
+            else:
+                heapq.heappush(heap, [piece[0], piece[1], back, piece[3]])
+            self.totals[flower] = self.totals.get(flower, 0) + back
+        if key in self.held:
+            if not pieces:
+                self.held[key].pop(flower, None)
+            if not self.held[key]:
+                del self.held[key]
+        return qty
+
+    def sync(self, inventory, vase_life=None, holders=()):
+        # подгоняет партии под итоги склада: прибавка — новая партия, убыль — списание FIFO;
+        # holders — [(ключ заказа, изменения)]: их списание запоминается, возврат восстанавливает партии
+        with excel_lock():
+            self._reload()
+            changed = False
+            for key, deltas in holders:
+                for f, d in deltas.items():
+                    d = int(d)
+                    if d > 0:
+                        self._restore(key, f, d)
+                    elif d < 0:
+                        taken = self._consume(f, -d)
+                        if taken:
+                            self.held.setdefault(key, {}).setdefault(f, []).extend(taken)
+                    changed = changed or d != 0
+            for f, total in inventory.items():
+                diff = max(int(total), 0) - self.totals.get(f, 0)
+                if diff > 0:
+                    self._add(f, diff, (vase_life or {}).get(f, DEFAULT_VASE_LIFE_DAYS))
+                elif diff < 0:
+                    self._consume(f, -diff)
+                changed = changed or diff != 0
+            if changed:
+                self._save()
+
+    def forget(self, keys):
+        # заказ ушёл в архив — его списания больше не вернутся на склад
+        with excel_lock():
+            self._reload()
+            dropped = [k for k in keys if self.held.pop(k, None) is not None]
+            if dropped:
+                self._save()
+
+    def expiring(self, until):
+        with excel_lock():
+            self._reload()
+            result = []
+            for f, heap in self.lots.items():
+                for received, seq, qty, expires in heap:
+                    if qty > 0 and expires <= until:
+                        result.append({"цветок": f, "кол-во": qty, "получено": received, "годен_до": expires})
+        result.sort(key=lambda r: (r["годен_до"], r["цветок"]))
+        return result
+
+
+lot_store = LotStore(LOTS_FILE)
+
+
+def lot_key(order):
+    # номера заказов в разных процессах могут совпасть, время создания их разводит
+    return f"{order['создан']}#{order['id']}"
+
+
+def save_inventory(inventory, path=None):
     
-    for col in flower_cols:
-        key = str(col)
-        if key in inventory:
-            df.at[sklad_row, col] = int(inventory[key])
+    with excel_lock():
+        df, name_col, flower_cols, sklad_row = read_frame(path)
 
-    
-    df.to_excel(EXCEL_FILE, sheet_name=SHEET_NAME, index=False, engine="openpyxl")
+        
+        for col in flower_cols:
+            key = str(col)
+            if key in inventory:
+                df.at[sklad_row, col] = int(inventory[key])
+
+        
+        write_frame(df, path)
+        # партии ведутся только для основного склада
+        if path in (None, EXCEL_FILE):
+            lot_store.sync(inventory)
+
+
+def apply_inventory_deltas(deltas, vase_life=None, path=None, holders=()):
+    # атомарно прибавляет deltas к остаткам за одну запись; остатки не уходят в минус;
+    # holders — по каким заказам эти изменения (см. LotStore.sync)
+    with excel_lock():
+        df, name_col, flower_cols, sklad_row = read_frame(path)
+        cols = {str(c): c for c in flower_cols}
+
+        unknown = [f for f in deltas if f not in cols]
+        if unknown:
+            raise ValueError("Неизвестные цветы: " + ", ".join(unknown))
+
+        result = {}
+        for f, d in deltas.items():
+            val = df.at[sklad_row, cols[f]]
+            try:
+                cur = int(val) if pd.notna(val) else 0
+            except (TypeError, ValueError):
+                cur = 0
+            result[f] = cur + int(d)
+            if result[f] < 0:
+                raise ValueError(f"Недостаточно {f} (осталось {cur})")
+
+        for f, q in result.items():
+            df.at[sklad_row, cols[f]] = q
+        write_frame(df, path)
+        if path in (None, EXCEL_FILE):
+            lot_store.sync(result, vase_life, holders)
+        return result
+
+def journal(event, **data):
+    # журнал событий склада: одна строка JSON на событие
+    rec = {"время": datetime.now().isoformat(timespec="seconds"), "событие": event}
+    rec.update(data)
+    with open(JOURNAL_FILE, "a", encoding="utf-8") as fh:
+        fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+
+def journal_order_stock(event, order, deltas):
+    # движение склада по заказу (минус — расход); день — день расхода заказа,
+    # поэтому возврат при удалении или истечении гасит исходный расход того же дня
+    deltas = {f: int(d) for f, d in deltas.items() if int(d)}
+    if not deltas:
+        return
+    rec = {"заказ": order["id"], "день": (order.get("выдача") or order["создан"])[:10], "строки": deltas}
+    if order.get("филиал"):
+        rec["филиал"] = order["филиал"]
+    journal(event, **rec)
 
 def backup_excel():
     if not os.path.exists(EXCEL_FILE):
@@ -132,7 +618,247 @@ def backup_excel():
 
     shutil.copy2(EXCEL_FILE, backup_name)
 
+# --------- фоновые задачи (импорт / сохранение Excel) ----------
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # состояние лежит в JOBS_DIR/<id>.json: опрос /jobs/<id> может попасть в любой воркер;
+    # отмена — файл-метка <id>.cancel, её видит воркер, выполняющий задачу
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.progress = 0
+        self.stage = ""
+        self.message = ""
+        self.result = None
+        self.created = datetime.now().isoformat(timespec="seconds")
+        # задача выполняется в воркере, который её поставил
+        self.pid = os.getpid()
+
+    @staticmethod
+    def path(job_id, ext="json"):
+        return os.path.join(JOBS_DIR, f"{job_id}.{ext}")
+
+    @classmethod
+    def load(cls, job_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+            return None
+        try:
+            with open(cls.path(job_id), encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        job = cls.__new__(cls)
+        job.__dict__.update(data)
+        return job
+
+    def save(self):
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        tmp = self.path(self.id, f"{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(self.__dict__, fh, ensure_ascii=False)
+        os.replace(tmp, self.path(self.id))
+
+    @property
+    def cancel_requested(self):
+        return os.path.exists(self.path(self.id, "cancel"))
+
+    def request_cancel(self):
+        open(self.path(self.id, "cancel"), "a").close()
+
+    def cleanup(self):
+        # метка отмены и загруженное тело нужны только пока задача выполняется
+        for ext in ("cancel", "upload"):
+            try:
+                os.remove(self.path(self.id, ext))
+            except FileNotFoundError:
+                pass
+
+    def worker_alive(self):
+        pid = getattr(self, "pid", None)
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def to_dict(self):
+        d = {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "stage": self.stage,
+            "message": self.message,
+            "created": self.created
+        }
+        if self.result is not None:
+            d["result"] = self.result
+        return d
+
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="excel-job")
+
+
+def job_step(job, progress, stage):
+    # точка отмены между этапами; для синхронного вызова job = None
+    if job is None:
+        return
+    if job.cancel_requested:
+        raise JobCancelled()
+    job.progress = progress
+    job.stage = stage
+    job.save()
+
+
+def run_job(job, fn, args):
+    try:
+        if job.cancel_requested:
+            job.status = "cancelled"
+            job.save()
+            return
+        job.status = "running"
+        job.save()
+        execute_job(job, fn, args)
+    finally:
+        job.cleanup()
+
+
+def execute_job(job, fn, args):
+    try:
+        result = fn(job, *args) or ""
+        # задача может вернуть словарь-отчёт (например, ошибки импорта по строкам)
+        if isinstance(result, dict):
+            job.result = result
+            job.message = result.get("message", "")
+            job.status = "done" if result.get("ok", True) else "failed"
+        else:
+            job.message = result
+            job.status = "done"
+        job.progress = 100
+    except JobCancelled:
+        job.status = "cancelled"
+    except Exception as e:
+        job.status = "failed"
+        job.message = str(e)
+    job.save()
+
+
+def prune_jobs():
+    # хранятся последние MAX_FINISHED_JOBS завершённых задач; задачи умершего воркера
+    # («queued»/«running» без процесса) считаются проваленными
+    finished = []
+    for name in os.listdir(JOBS_DIR):
+        if not name.endswith(".json"):
+            continue
+        job = Job.load(name[:-5])
+        if job is None:
+            continue
+        if job.status in ("queued", "running"):
+            if job.worker_alive():
+                continue
+            job.status = "failed"
+            job.message = "Задача прервана: воркер остановлен"
+            job.save()
+            job.cleanup()
+        finished.append((job.created, job.id))
+    finished.sort()
+    for created, job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        os.remove(Job.path(job_id))
+
+
+def submit_job(kind, fn, *args, upload=None):
+    # upload — поток тела запроса: сохраняется в JOBS_DIR/<id>.upload, задача читает его оттуда
+    job = Job(kind)
+    if upload is not None:
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        with open(job.path(job.id, "upload"), "wb") as fh:
+            shutil.copyfileobj(upload, fh)
+    job.save()
+    prune_jobs()
+    job_executor.submit(run_job, job, fn, args)
+    return job
+
+
+# --------- допуск тяжёлых запросов ----------
+# слоты — файлы с flock: замок держится открытым файлом, поэтому считается на все
+# воркеры и потоки и снимается сам, если процесс упал
+
+class AdmissionGate:
+
+    def __init__(self, directory, slots, queue, wait):
+        self.directory = directory
+        self.slots = slots
+        self.queue = queue
+        self.wait = wait
+
+    def _take(self, prefix, n):
+        os.makedirs(self.directory, exist_ok=True)
+        for i in range(n):
+            fh = open(os.path.join(self.directory, f"{prefix}-{i}.lock"), "a")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fh
+            except BlockingIOError:
+                fh.close()
+        return None
+
+    def acquire(self):
+        # открытый файл слота или None, если не дождались
+        slot = self._take("slot", self.slots)
+        if slot is not None:
+            return slot
+        ticket = self._take("queue", self.queue)
+        if ticket is None:
+            return None
+        try:
+            deadline = time.monotonic() + self.wait
+            while slot is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                slot = self._take("slot", self.slots)
+            return slot
+        finally:
+            ticket.close()
+
+
+admission_gate = AdmissionGate(ADMISSION_DIR, HEAVY_SLOTS, HEAVY_QUEUE, HEAVY_WAIT_SECONDS)
+
+
+def heavy(fn):
+    # тяжёлый маршрут: выполняется только в свободном слоте; потоковый ответ держит
+    # слот до конца передачи
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        slot = admission_gate.acquire()
+        if slot is None:
+            resp = jsonify({"error": "Сервер занят тяжёлыми операциями, повторите позже"})
+            resp.status_code = 503
+            resp.headers["Retry-After"] = str(HEAVY_RETRY_AFTER_SECONDS)
+            return resp
+        try:
+            resp = app.make_response(fn(*args, **kwargs))
+        except Exception:
+            slot.close()
+            raise
+        if resp.is_streamed:
+            resp.call_on_close(slot.close)
+        else:
+            slot.close()
+        return resp
+    return wrapper
+
+
 @app.route("/excel")
+@heavy
 def excel_editor():
     if not os.path.exists(EXCEL_FILE):
         return "Excel файл не найден", 404
@@ -205,6 +931,10 @@ button { margin-top: 15px; padding: 8px 16px; }
   z-index: 4;
   background: #eaeaea;
 }
+
+#excel td.bad {
+  background: #f8c8c8;
+}
 </style>
 </head>
 <body>
@@ -234,6 +964,7 @@ button { margin-top: 15px; padding: 8px 16px; }
 
 <br>
 <button onclick="saveExcel()">Сохранить</button>
+<button id="cancelBtn" style="display:none">Отменить</button>
 <p id="msg" style="color:red;"></p>
 
 <script>
@@ -252,12 +983,49 @@ function saveExcel() {
     fetch(window.location.origin + "/excel/save", {
         method: "POST",
         headers: {"Content-Type": "application/json"},
-        body: JSON.stringify({table: data})
+        body: JSON.stringify({table: data, async: true})
     })
     .then(r => r.json())
     .then(resp => {
-        document.getElementById("msg").innerText = resp.message;
-        if (resp.ok) document.getElementById("msg").style.color = "green";
+        for (let td of table.querySelectorAll("td.bad")) {
+            td.classList.remove("bad");
+            td.title = "";
+        }
+        let text = resp.message || resp.error;
+        for (let e of resp.errors || []) {
+            const td = table.rows[e.row].cells[e.col];
+            td.classList.add("bad");
+            td.title = e.error;
+        }
+        if (resp.errors && resp.errors.length) {
+            text += ": " + resp.errors.slice(0, 5).map(e => `${e.cell} — ${e.error}`).join("; ");
+        }
+        showMsg(text, false);
+        if (resp.job) pollJob(resp.job);
+    });
+}
+
+function showMsg(text, ok) {
+    const msg = document.getElementById("msg");
+    msg.innerText = text;
+    msg.style.color = ok ? "green" : "red";
+}
+
+function pollJob(id) {
+    document.getElementById("cancelBtn").style.display = "";
+    document.getElementById("cancelBtn").onclick = () => fetch(`/jobs/${id}/cancel`, {method: "POST"});
+    fetch(`/jobs/${id}`)
+    .then(r => r.json())
+    .then(job => {
+        if (job.status === "queued" || job.status === "running") {
+            showMsg(`${job.stage || "в очереди"}… ${job.progress}%`, false);
+            setTimeout(() => pollJob(id), 500);
+            return;
+        }
+        document.getElementById("cancelBtn").style.display = "none";
+        if (job.status === "done") showMsg(job.message, true);
+        else if (job.status === "cancelled") showMsg("Сохранение отменено", false);
+        else showMsg(job.message || "Ошибка сохранения", false);
     });
 }
 </script>
@@ -266,20 +1034,86 @@ function saveExcel() {
 </html>
 """, df=df)
 
-@app.route("/excel/save", methods=["POST"])
-def excel_save():
-    data = request.json.get("table", [])
-
-    if len(data) < 2:
-        return jsonify(ok=False, message="Пустая таблица"), 400
-
-    headers = data[0]
-    rows = data[1:]
+def excel_cells(data):
+    # ячейки таблицы редактора как массив объектов; короткие строки дополняются пустыми
+    headers = [str(h).strip() for h in data[0]]
+    width = len(headers)
+    rows = [r if len(r) == width else (list(r) + [""] * width)[:width] for r in data[1:]]
+    return headers, np.array(rows, dtype=object).reshape(len(rows), width)
+
+
+def excel_text(column):
+    return pd.Series(column, dtype=object).fillna("").astype(str).str.strip()
+
+
+def excel_quantities(qty):
+    # (числа, пустые) для ячеек количеств. Различных значений в таблице единицы, поэтому
+    # строки разбираются одним pd.to_numeric по уникальным значениям и раскладываются
+    # обратно по кодам; пустое — 0, не число — NaN
+    codes, uniques = pd.factorize(qty.ravel())
+    text = excel_text(uniques)
+    blank = np.append((text == "").to_numpy(), True)
+    nums = np.append(pd.to_numeric(text.where(text != ""), errors="coerce").to_numpy(dtype=float), 0.0)
+    # код -1 (None, NaN) попадает на добавленный последним элемент — пустую ячейку
+    blank = blank[codes].reshape(qty.shape)
+    nums = nums[codes].reshape(qty.shape)
+    nums[blank] = 0
+    return nums, blank
+
+
+def validate_excel_grid(data):
+    # вся таблица проверяется целиком, до резервной копии и записи;
+    # адреса ячеек — как в редакторе: строка 1 — заголовок, столбец A — названия
+    headers, cells = excel_cells(data)
+    if cells.shape[1] < 2:
+        return [], 0
+
+    names = norm_series(pd.Series(cells[:, 0], dtype=object))
+    sklad = (names == "склад").to_numpy()[:, None]
+
+    nums, _ = excel_quantities(cells[:, 1:])
+    finite = np.isfinite(nums)
+    whole = finite & (nums == np.floor(nums))
+    in_range = np.abs(nums) <= EXCEL_MAX_INT
+    codes = np.zeros(cells.shape, dtype=np.int8)
+    qty_codes = codes[:, 1:]
+    qty_codes[~finite] = 1
+    qty_codes[finite & ~whole] = 2
+    qty_codes[whole & in_range & (nums < 0) & ~sklad] = 3
+    qty_codes[whole & in_range & (nums < 0) & sklad] = 4
+    qty_codes[whole & ~in_range] = 6
+    # столбцы без заголовка при сохранении отбрасываются
+    codes[:, [h == "" for h in headers]] = 0
+    codes[:, 0][((names != "") & names.duplicated(keep=False)).to_numpy()] = 5
+
+    messages = {
+        1: "не число",
+        2: "количество должно быть целым",
+        3: "отрицательное количество",
+        4: "отрицательный остаток",
+        5: "повторяющееся название",
+        6: "слишком большое число",
+    }
+    rows, cols = np.nonzero(codes)
+    errors = []
+    for r, c in zip(rows[:MAX_BULK_ERRORS], cols[:MAX_BULK_ERRORS]):
+        errors.append({
+            "cell": f"{get_column_letter(c + 1)}{r + 2}",
+            "row": int(r) + 1,
+            "col": int(c),
+            "value": str(cells[r, c]).strip(),
+            "error": messages[codes[r, c]],
+        })
+    return errors, len(rows)
+
+
+def build_excel_frame(data, job=None):
+    job_step(job, 5, "разбор таблицы")
+    headers, cells = excel_cells(data)
     clean_headers = []
     seen = set()
 
-    for h in headers:
-        name = str(h).strip()
+    for name in headers:
         if name == "":
             clean_headers.append(None)
             continue
@@ -292,77 +1126,1037 @@ def excel_save():
 
         seen.add(name)
         clean_headers.append(name)
-    
-    df = pd.DataFrame(rows, columns=clean_headers)
-    df = df.loc[:, df.columns.notna()]
-
-    
-    for col in df.columns[1:]:
-        df[col] = df[col].apply(lambda x: 0 if str(x).strip() == "" else x)
-        df[col] = pd.to_numeric(df[col], errors="ignore")
 
-    name_col = df.columns[0]
+    keep = [i for i, h in enumerate(clean_headers) if h is not None]
+    cells = cells[:, keep]
+    columns = [clean_headers[i] for i in keep]
 
-    
-    df = df.loc[:, ~(df.astype(str).apply(
-        lambda col: col.str.strip().eq("").all()
-    ))]
+    # таблица уже проверена validate_excel_grid: пустое количество — 0, остальное — целые
+    job_step(job, 20, "преобразование чисел")
+    names = excel_text(cells[:, 0]).to_numpy()
+    nums, blank = excel_quantities(cells[:, 1:])
 
-    
-    df = df[~(df.astype(str).apply(
-        lambda row: row.str.strip().eq("").all(), axis=1
-    ))]
+    job_step(job, 50, "удаление пустых строк")
+    filled = (names != "") | ~blank.all(axis=1)
+    df = pd.DataFrame(nums[filled].astype(np.int64), columns=columns[1:])
+    df.insert(0, columns[0], names[filled])
 
-    
-    mask = df[name_col].astype(str).map(lambda x: norm(x) == "склад")
+    mask = norm_series(df[columns[0]]) == "склад"
     if not mask.any():
-        return jsonify(
-            ok=False,
-            message="Строка «Склад» обязательна и не может быть удалена"
-        )
+        raise ValueError("Строка «Склад» обязательна и не может быть удалена")
 
     
     sklad_row = df[mask]
     df = df[~mask]
-    df = pd.concat([df, sklad_row], ignore_index=True)
+    return pd.concat([df, sklad_row], ignore_index=True)
 
-    backup_excel()
 
+def excel_save_job(job, data):
+    df = build_excel_frame(data, job)
+    with excel_lock():
+        job_step(job, 70, "резервная копия")
+        backup_excel()
+        # после начала записи отмена уже невозможна
+        job_step(job, 80, "запись")
+        write_frame(df)
+        # правки склада в редакторе переносятся в партии
+        lot_store.sync(load_data()[1])
+    return "Excel успешно сохранён"
+
+
+@app.route("/excel/save", methods=["POST"])
+@heavy
+def excel_save():
+    payload = request.json or {}
+    data = payload.get("table", [])
+
+    if len(data) < 2:
+        return jsonify(ok=False, message="Пустая таблица"), 400
+
+    errors, n_errors = validate_excel_grid(data)
+    if n_errors:
+        return jsonify(ok=False, message=f"Таблица не сохранена: ошибок {n_errors}",
+                       errors=errors, errors_total=n_errors), 400
+
+    if payload.get("async"):
+        job = submit_job("excel_save", excel_save_job, data)
+        return jsonify(ok=True, job=job.id, message="Сохранение запущено"), 202
+
+    try:
+        message = excel_save_job(None, data)
+    except ValueError as e:
+        return jsonify(ok=False, message=str(e))
+    return jsonify(ok=True, message=message)
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = Job.load(job_id)
+    if job is None:
+        return jsonify(ok=False, message="Задача не найдена"), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    job = Job.load(job_id)
+    if job is None:
+        return jsonify(ok=False, message="Задача не найдена"), 404
+    if job.status in ("queued", "running"):
+        job.request_cancel()
+    return jsonify(job.to_dict())
+
+
+# --------- массовый импорт / экспорт (CSV / NDJSON) ----------
+
+def to_qty(x):
+    if isinstance(x, bool):
+        raise ValueError(x)
+    if isinstance(x, float):
+        if not x.is_integer():
+            raise ValueError(x)
+        return int(x)
+    return int(str(x).strip())
+
+
+def bulk_format():
+    fmt = (request.args.get("format") or "").lower()
+    if fmt in ("csv", "ndjson"):
+        return fmt
+    return "ndjson" if "json" in (request.mimetype or "") else "csv"
 
-    df.to_excel(
-        EXCEL_FILE,
-        sheet_name=SHEET_NAME,
-        index=False,
-        engine="openpyxl"
-    )
 
-    return jsonify(ok=True, message="Excel успешно сохранён")
+STOCK_CSV_HEADER = ["цветок", "кол-во"]
+RECIPES_CSV_HEADER = ["букет", "цветок", "кол-во"]
 
 
+def iter_bulk_records(stream, fmt, header=None):
+    # тело запроса читается построчно, память не зависит от размера файла
+    text = io.TextIOWrapper(io.BufferedReader(stream), encoding="utf-8-sig", newline="")
+    if fmt == "ndjson":
+        for line_no, line in enumerate(text, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                yield line_no, None, "некорректный JSON"
+                continue
+            if not isinstance(rec, dict):
+                yield line_no, None, "ожидался JSON-объект"
+                continue
+            yield line_no, rec, None
+        return
+
+    reader = csv.reader(text)
+    for row in reader:
+        row = [c.strip() for c in row]
+        if not any(row):
+            continue
+        # заголовок пропускается только если совпадают названия колонок
+        if reader.line_num == 1 and header and [norm(c) for c in row] == [norm(c) for c in header]:
+            continue
+        yield reader.line_num, row, None
+
 
-def recompute_order_summary(order):
-     
-    total = {}
-    if 'букеты' in order:
-        for b in order['букеты']:
-            for f, q in b['состав'].items():
-                total[f] = total.get(f, 0) + q
-        order['состав'] = total
-        order['букет'] = ", ".join([b.get('название', '') for b in order['букеты']])
+def parse_stock_record(rec, known):
+    if isinstance(rec, dict):
+        flower, qty = rec.get("flower"), rec.get("qty")
+    elif len(rec) == 2:
+        flower, qty = rec
     else:
-        
-        pass
-    return order
+        return None, None, "ожидалось 2 поля: цветок, кол-во"
+    col = known.canonical(flower)
+    if col is None:
+        return None, None, f"неизвестный цветок: {flower}"
+    try:
+        return col, to_qty(qty), None
+    except (TypeError, ValueError):
+        return None, None, f"некорректное количество: {qty}"
+
+
+def parse_recipe_record(rec, known):
+    if isinstance(rec, dict):
+        name = rec.get("букет")
+        comp = rec.get("состав")
+        if not isinstance(comp, dict) or not comp:
+            return None, None, "пустой или некорректный состав"
+        items = list(comp.items())
+    elif len(rec) == 3:
+        name, items = rec[0], [(rec[1], rec[2])]
+    else:
+        return None, None, "ожидалось 3 поля: букет, цветок, кол-во"
+
+    name = str(name or "").strip()
+    if norm(name) in ("", "склад"):
+        return None, None, f"некорректное название букета: {name}"
+    parsed = {}
+    for flower, qty in items:
+        col = known.canonical(flower)
+        if col is None:
+            return None, None, f"неизвестный цветок: {flower}"
+        try:
+            q = to_qty(qty)
+        except (TypeError, ValueError):
+            return None, None, f"некорректное количество: {qty}"
+        if q < 0:
+            return None, None, f"отрицательное количество: {flower}"
+        parsed[col] = q
+    return name, parsed, None
+
+
+def save_recipes(recipes):
+    # полная замена таблицы рецептов; строка «склад» сохраняется последней
+    with excel_lock():
+        df, name_col, flower_cols, sklad_row = read_frame()
+        cols = {str(c): c for c in flower_cols}
+        rows = []
+        for name, comp in recipes.items():
+            row = {name_col: name}
+            for f, q in comp.items():
+                if q > 0:
+                    row[cols[f]] = q
+            rows.append(row)
+        new_df = pd.concat(
+            [pd.DataFrame(rows, columns=df.columns), df.loc[[sklad_row]]],
+            ignore_index=True
+        )
+        backup_excel()
+        write_frame(new_df)
 
-def ensure_order_buckets(order):
-    
-    if 'букеты' not in order:
-        name = order.get('букет', '')
-        comp = order.get('состав', {}) or {}
-        order['букеты'] = [{"название": name, "состав": comp.copy()}]
+
+def csv_line(row):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue()
+
+
+def bulk_response(lines, fmt, filename):
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "text/csv"
+    return Response(
+        stream_with_context(lines),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}.{fmt}"}
+    )
+
+
+def bulk_stock_apply(job, stream, fmt, mode, path=None):
+    try:
+        known = flower_registry()
+    except Exception:
+        return {"ok": False, "message": "Ошибка чтения Excel"}, 500
+
+    values = {}
+    errors = []
+    n_errors = 0
+    for line_no, rec, err in iter_bulk_records(stream, fmt, STOCK_CSV_HEADER):
+        if line_no % 1000 == 0:
+            job_step(job, 10, f"разбор: строка {line_no}")
+        if err is None:
+            flower, qty, err = parse_stock_record(rec, known)
+        if err is None and mode == "set" and qty < 0:
+            err = f"отрицательный остаток: {flower}"
+        if err:
+            n_errors += 1
+            if len(errors) < MAX_BULK_ERRORS:
+                errors.append({"line": line_no, "error": err})
+            continue
+        if mode == "delta":
+            values[flower] = values.get(flower, 0) + qty
+        else:
+            values[flower] = qty
+
+    if n_errors:
+        return {"ok": False, "message": "Файл не применён: есть ошибки", "errors": errors, "errors_total": n_errors}, 400
+
+    job_step(job, 80, "запись")
+    try:
+        if mode == "delta":
+            apply_inventory_deltas(values, path=path)
+        else:
+            save_inventory(values, path)
+    except ValueError as e:
+        return {"ok": False, "message": str(e)}, 400
+    except Exception as e:
+        return {"ok": False, "message": "Ошибка записи Excel: " + str(e)}, 500
+    return {"ok": True, "message": "Остатки обновлены", "flowers": len(values)}, 200
+
+
+def bulk_recipes_apply(job, stream, fmt):
+    try:
+        known = flower_registry()
+    except Exception:
+        return {"ok": False, "message": "Ошибка чтения Excel"}, 500
+
+    recipes = {}
+    names = {}
+    errors = []
+    n_errors = 0
+    for line_no, rec, err in iter_bulk_records(stream, fmt, RECIPES_CSV_HEADER):
+        if line_no % 1000 == 0:
+            job_step(job, 10, f"разбор: строка {line_no}")
+        if err is None:
+            name, comp, err = parse_recipe_record(rec, known)
+        if err:
+            n_errors += 1
+            if len(errors) < MAX_BULK_ERRORS:
+                errors.append({"line": line_no, "error": err})
+            continue
+        # строки одного букета (в т.ч. разные написания) собираются в один рецепт
+        key = names.setdefault(norm(name), name)
+        recipes.setdefault(key, {}).update(comp)
+
+    if n_errors:
+        return {"ok": False, "message": "Файл не применён: есть ошибки", "errors": errors, "errors_total": n_errors}, 400
+    if not recipes:
+        return {"ok": False, "message": "Пустой файл"}, 400
+
+    job_step(job, 80, "запись")
+    try:
+        save_recipes(recipes)
+    except Exception as e:
+        return {"ok": False, "message": "Ошибка записи Excel: " + str(e)}, 500
+    return {"ok": True, "message": "Рецепты заменены", "bouquets": len(recipes)}, 200
+
+
+def bulk_upload_job(job, apply, *args):
+    # файл уже сохранён на диск запросом; удаляет его run_job при любом исходе
+    with open(job.path(job.id, "upload"), "rb") as fh:
+        return apply(job, fh, *args)[0]
+
+
+def run_bulk(kind, apply, *args):
+    # ?async=1 — тело сохраняется в файл и разбирается в очереди задач, ответ 202 с id задачи
+    if request.args.get("async") in ("1", "true"):
+        job = submit_job(kind, bulk_upload_job, apply, *args, upload=request.stream)
+        return jsonify(ok=True, job=job.id, message="Импорт запущен"), 202
+    result, code = apply(None, request.stream, *args)
+    return jsonify(result), code
+
+
+@app.route("/bulk/stock", methods=["POST"])
+@heavy
+def bulk_stock_import():
+    mode = request.args.get("mode", "delta")
+    if mode not in ("delta", "set"):
+        return jsonify(ok=False, message="mode должен быть delta или set"), 400
+    branch = parse_branch(request.args.get("branch"))
+    if branch is False:
+        return jsonify(ok=False, message="Неизвестный филиал"), 404
+    return run_bulk("bulk_stock", bulk_stock_apply, bulk_format(), mode, branch_file(branch) if branch else None)
+
+
+@app.route("/bulk/recipes", methods=["POST"])
+@heavy
+def bulk_recipes_import():
+    return run_bulk("bulk_recipes", bulk_recipes_apply, bulk_format())
+
+
+@app.route("/bulk/stock", methods=["GET"])
+@heavy
+def bulk_stock_export():
+    fmt = bulk_format()
+    branch = parse_branch(request.args.get("branch"))
+    if branch is False:
+        return jsonify(ok=False, message="Неизвестный филиал"), 404
+    try:
+        bouquets, inventory = load_branch_data(branch)
+    except Exception:
+        return jsonify(ok=False, message="Ошибка чтения Excel"), 500
+
+    def generate():
+        if fmt == "csv":
+            yield csv_line(STOCK_CSV_HEADER)
+        for f, q in inventory.items():
+            if fmt == "csv":
+                yield csv_line([f, q])
+            else:
+                yield json.dumps({"flower": f, "qty": q}, ensure_ascii=False) + "\n"
+
+    return bulk_response(generate(), fmt, "stock")
+
+
+@app.route("/bulk/recipes", methods=["GET"])
+@heavy
+def bulk_recipes_export():
+    fmt = bulk_format()
+    try:
+        bouquets, inventory = load_data()
+    except Exception:
+        return jsonify(ok=False, message="Ошибка чтения Excel"), 500
+
+    def generate():
+        if fmt == "csv":
+            yield csv_line(RECIPES_CSV_HEADER)
+        for name, comp in bouquets.items():
+            if fmt == "csv":
+                for f, q in comp.items():
+                    yield csv_line([name, f, q])
+            else:
+                yield json.dumps({"букет": name, "состав": comp}, ensure_ascii=False) + "\n"
+
+    return bulk_response(generate(), fmt, "recipes")
+
+
+
+# --------- рецепты и заказы ----------
+# заказ ссылается на неизменяемую версию рецепта и хранит только отличия от неё;
+# суммарный состав заказа считается лениво и кэшируется до следующей правки
+
+class Recipe:
+    __slots__ = ("id", "name", "version", "items")
+
+    def __init__(self, rid, name, version, items):
+        self.id = rid
+        self.name = name
+        self.version = version
+        self.items = items
+
+    def composition(self):
+        return dict(self.items)
+
+    def to_dict(self):
+        return {"id": self.id, "название": self.name, "версия": self.version, "состав": self.composition()}
+
+
+recipes_by_key = {}
+recipes_by_id = []
+recipe_versions = {}
+
+
+def intern_recipe(name, comp):
+    key = (norm(name), tuple(sorted((str(f), int(q)) for f, q in comp.items() if int(q) > 0)))
+    recipe = recipes_by_key.get(key)
+    if recipe is None:
+        version = recipe_versions.get(key[0], 0) + 1
+        recipe_versions[key[0]] = version
+        recipe = Recipe(len(recipes_by_id), key[0], version, key[1])
+        recipes_by_key[key] = recipe
+        recipes_by_id.append(recipe)
+    return recipe
+
+
+def base_bouquet_name(name):
+    # «Ньютон (с заменой 2)» -> «Ньютон»
+    return re.sub(r"\s*\(с заменой[^)]*\)\s*$", "", str(name or ""))
+
+
+class BouquetLine:
+    __slots__ = ("name", "recipe", "overrides", "with_replacement", "shortage_text", "replacements", "owner")
+
+    KEYS = {
+        "название": "name",
+        "with_replacement": "with_replacement",
+        "shortage_text": "shortage_text",
+        "replacements": "replacements"
+    }
+
+    def __init__(self, name, recipe, comp=None, with_replacement=False):
+        self.name = name
+        self.recipe = recipe
+        self.overrides = None
+        self.with_replacement = with_replacement
+        self.shortage_text = None
+        self.replacements = None
+        self.owner = None
+        if comp is not None:
+            self.set_composition(comp)
+
+    @classmethod
+    def build(cls, name, comp, bouquets, with_replacement=False):
+        # отличия считаются от рецепта из каталога; если его нет — сам состав становится рецептом
+        base = bouquets.get(norm(base_bouquet_name(name)))
+        recipe = intern_recipe(base_bouquet_name(name), base) if base else intern_recipe(name, comp)
+        return cls(name, recipe, comp, with_replacement)
+
+    def composition(self):
+        comp = self.recipe.composition()
+        if self.overrides:
+            for f, q in self.overrides.items():
+                if q:
+                    comp[f] = q
+                else:
+                    comp.pop(f, None)
+        return comp
+
+    def set_composition(self, comp):
+        base = dict(self.recipe.items)
+        overrides = {f: int(q) for f, q in comp.items() if base.get(f) != int(q)}
+        overrides.update({f: 0 for f in base if f not in comp})
+        self.overrides = overrides or None
+        if self.owner is not None:
+            self.owner.touch()
+
+    def __getitem__(self, key):
+        if key == "состав":
+            return self.composition()
+        return getattr(self, self.KEYS[key])
+
+    def __setitem__(self, key, value):
+        if key == "состав":
+            self.set_composition(value)
+        else:
+            setattr(self, self.KEYS[key], value)
+            if self.owner is not None:
+                self.owner.touch()
+
+    def __contains__(self, key):
+        return key == "состав" or (key in self.KEYS and getattr(self, self.KEYS[key]) is not None)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        value = self[key]
+        return default if value is None else value
+
+    def to_dict(self):
+        d = {"название": self.name, "состав": self.composition(), "рецепт": self.recipe.id}
+        for key in ("with_replacement", "shortage_text", "replacements"):
+            if self.get(key) is not None:
+                d[key] = self.get(key)
+        return d
+
+
+class Order:
+    __slots__ = ("id", "number", "lines", "status", "created", "expires", "branch", "pickup", "deferred", "released", "version", "_total")
+
+    KEYS = {
+        "id": "id",
+        "номер": "number",
+        "букеты": "lines",
+        "статус": "status",
+        "создан": "created",
+        "истекает": "expires",
+        "филиал": "branch",
+        "выдача": "pickup",
+        "отложено": "deferred",
+        "возвращено": "released"
+    }
+
+    def __init__(self, number, lines, status="забронировано", created=None, expires=None, branch=None, pickup=None):
+        self.id = None
+        self.number = number
+        self.lines = lines
+        self.status = status
+        self.created = created or datetime.now().isoformat(timespec="seconds")
+        self.expires = expires
+        self.branch = branch
+        # предзаказ списывается со склада только в момент выдачи
+        self.pickup = pickup
+        self.deferred = pickup is not None
+        # цветы снятого заказа уже вернулись на склад
+        self.released = False
+        self.version = 0
+        self._total = None
+        for line in lines:
+            line.owner = self
+
+    def touch(self):
+        self._total = None
+        self.version += 1
+
+    def total(self):
+        if self._total is None:
+            total = {}
+            for line in self.lines:
+                for f, q in line.composition().items():
+                    total[f] = total.get(f, 0) + q
+            self._total = total
+        return self._total
+
+    def __getitem__(self, key):
+        if key == "состав":
+            return self.total()
+        if key == "букет":
+            return ", ".join(line.name for line in self.lines)
+        return getattr(self, self.KEYS[key])
+
+    def __setitem__(self, key, value):
+        # «состав» и «букет» — сводка по букетам; у заказа из нескольких букетов
+        # они правятся через order["букеты"][i]
+        if key in ("состав", "букет"):
+            if len(self.lines) != 1:
+                raise TypeError(f"«{key}» заказа из нескольких букетов задаётся по букетам")
+            self.lines[0][key if key == "состав" else "название"] = value
+        else:
+            setattr(self, self.KEYS[key], value)
+        self.touch()
+
+    def __contains__(self, key):
+        return key in ("состав", "букет") or key in self.KEYS
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        value = self[key]
+        return default if value is None else value
+
+    def to_dict(self):
+        d = {
+            "id": self.id,
+            "номер": self.number,
+            "букеты": [line.to_dict() for line in self.lines],
+            "букет": self["букет"],
+            "состав": dict(self.total()),
+            "статус": self.status,
+            "создан": self.created,
+            "истекает": self.expires
+        }
+        if self.branch:
+            d["филиал"] = self.branch
+        if self.pickup:
+            d["выдача"] = self.pickup
+            d["отложено"] = self.deferred
+        if self.released:
+            d["возвращено"] = True
+        return d
+
+
+# --------- подписчики на изменения заказов ----------
+# агрегаты и индексы обновляются инкрементально: remove() до изменения заказа, add() после
+
+order_listeners = []
+
+
+def order_added(order):
+    for listener in order_listeners:
+        listener.add(order)
+
+
+def order_removed(order):
+    for listener in order_listeners:
+        listener.remove(order)
+
+
+order_ids = itertools.count(1)
+orders_by_id = {}
+
+
+def add_order(order):
+    if order.get("id") is None:
+        order["id"] = next(order_ids)
+    orders.insert(0, order)
+    orders_by_id[order["id"]] = order
+    order_added(order)
+    if order.get("истекает"):
+        expiry_scheduler.schedule(order["истекает"], order["id"])
+    if order.get("отложено"):
+        pickup_scheduler.schedule(order["выдача"], order["id"])
+
+
+def pop_order(index):
+    order = orders.pop(index)
+    orders_by_id.pop(order.get("id"), None)
+    order_removed(order)
     return order
 
 
+@contextmanager
+def changing_order(order):
+    order_removed(order)
+    try:
+        yield order
+    finally:
+        order_added(order)
+
+
+class DailyStats:
+    # день -> статус -> {"orders": n, "bouquets": {букет: {"count": n, "flowers": {цветок: q}}}}
+
+    def __init__(self):
+        self.days = {}
+        self.sorted_days = []
+
+    def add(self, order):
+        self._apply(order, 1)
+
+    def remove(self, order):
+        self._apply(order, -1)
+
+    def _apply(self, order, sign):
+        created = order.get("создан")
+        if not created:
+            return
+        day = created[:10]
+        bucket = self.days.get(day)
+        if bucket is None:
+            bucket = self.days[day] = {}
+            bisect.insort(self.sorted_days, day)
+        status = order.get("статус")
+        cell = bucket.setdefault(status, {"orders": 0, "bouquets": {}})
+        cell["orders"] += sign
+
+        lines = order.get("букеты") or [{"название": order.get("букет", ""), "состав": order.get("состав") or {}}]
+        for b in lines:
+            name = norm(b.get("название"))
+            entry = cell["bouquets"].setdefault(name, {"count": 0, "flowers": {}})
+            entry["count"] += sign
+            flowers = entry["flowers"]
+            for f, q in (b.get("состав") or {}).items():
+                flowers[f] = flowers.get(f, 0) + sign * int(q)
+                if flowers[f] == 0:
+                    del flowers[f]
+            if entry["count"] == 0 and not flowers:
+                del cell["bouquets"][name]
+
+        if cell["orders"] == 0 and not cell["bouquets"]:
+            del bucket[status]
+        if not bucket:
+            del self.days[day]
+            self.sorted_days.pop(bisect.bisect_left(self.sorted_days, day))
+
+    def iter_range(self, start, end, statuses=None):
+        # (день, статус, ячейка) для start <= день <= end
+        lo = bisect.bisect_left(self.sorted_days, start)
+        hi = bisect.bisect_right(self.sorted_days, end)
+        for day in self.sorted_days[lo:hi]:
+            for status, cell in self.days[day].items():
+                if statuses and status not in statuses:
+                    continue
+                yield day, status, cell
+
+
+daily_stats = DailyStats()
+order_listeners.append(daily_stats)
+
+
+class OrderIndex:
+    # инвертированные индексы для поиска: номер, букет, цветок, статус; по дате — отсортированный список
+
+    def __init__(self):
+        self.by_number = {}
+        self.by_bouquet = {}
+        self.by_flower = {}
+        self.by_status = {}
+        self.by_created = []
+        self.keys = {}
+
+    def _order_keys(self, order):
+        bouquets = set()
+        for b in order.get("букеты") or []:
+            bouquets.add(norm(b.get("название")))
+            bouquets.add(norm(base_bouquet_name(b.get("название"))))
+        return {
+            "by_number": {str(order.get("номер"))},
+            "by_bouquet": bouquets,
+            "by_flower": {norm(f) for f in order.get("состав") or {}},
+            "by_status": {order.get("статус")},
+            "created": order.get("создан") or ""
+        }
+
+    def add(self, order):
+        oid = order.get("id")
+        keys = self._order_keys(order)
+        self.keys[oid] = keys
+        for name in ("by_number", "by_bouquet", "by_flower", "by_status"):
+            index = getattr(self, name)
+            for k in keys[name]:
+                index.setdefault(k, set()).add(oid)
+        bisect.insort(self.by_created, (keys["created"], oid))
+
+    def remove(self, order):
+        oid = order.get("id")
+        keys = self.keys.pop(oid, None)
+        if keys is None:
+            return
+        for name in ("by_number", "by_bouquet", "by_flower", "by_status"):
+            index = getattr(self, name)
+            for k in keys[name]:
+                ids = index.get(k)
+                if ids is not None:
+                    ids.discard(oid)
+                    if not ids:
+                        del index[k]
+        i = bisect.bisect_left(self.by_created, (keys["created"], oid))
+        if i < len(self.by_created) and self.by_created[i] == (keys["created"], oid):
+            self.by_created.pop(i)
+
+    def search(self, number=None, bouquet=None, flower=None, status=None, start=None, end=None):
+        candidates = []
+        if number:
+            candidates.append(self.by_number.get(str(number), set()))
+        if bouquet:
+            candidates.append(self.by_bouquet.get(norm(bouquet), set()))
+        if flower:
+            candidates.append(self.by_flower.get(norm(flower), set()))
+        if status:
+            candidates.append(self.by_status.get(status, set()))
+        if start or end:
+            lo = bisect.bisect_left(self.by_created, (start or "",))
+            hi = bisect.bisect_left(self.by_created, (end or "\uffff",))
+            candidates.append({oid for _, oid in self.by_created[lo:hi]})
+        if not candidates:
+            return sorted(self.keys, reverse=True)
+        candidates.sort(key=len)
+        result = set(candidates[0])
+        for ids in candidates[1:]:
+            result &= ids
+        return sorted(result, reverse=True)
+
+
+order_index = OrderIndex()
+order_listeners.append(order_index)
+
+# --------- истечение брони ----------
+
+def reservation_deadline(ttl_minutes=None):
+    try:
+        ttl = int(ttl_minutes) if ttl_minutes not in (None, "") else RESERVATION_TTL_MINUTES
+    except (TypeError, ValueError):
+        ttl = RESERVATION_TTL_MINUTES
+    if ttl <= 0:
+        return None
+    return (datetime.now() + timedelta(minutes=ttl)).isoformat(timespec="seconds")
+
+
+class ExpiryScheduler:
+    # один фоновый поток и min-куча сроков; снятые/оплаченные заказы просто
+    # пропускаются при срабатывании, поэтому отмена брони ничего не стоит
+
+    def __init__(self, on_expire):
+        self.heap = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.on_expire = on_expire
+
+    def schedule(self, when, order_id):
+        deadline = datetime.fromisoformat(when).timestamp()
+        with self.cond:
+            heapq.heappush(self.heap, (deadline, order_id))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="reservation-expiry", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                wait = self.heap[0][0] - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                now = time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[1])
+            try:
+                self.on_expire(due)
+            except Exception:
+                app.logger.exception("Ошибка при снятии просроченных броней")
+
+
+def release_expired(order_ids_due):
+    # просроченные брони снимаются пачкой: цветы возвращаются одной записью в Excel,
+    # заказ остаётся в списке со статусом отмены — позиции остальных заказов не сдвигаются
+    now = datetime.now().isoformat(timespec="seconds")
+    with excel_lock():
+        expired = []
+        for oid in order_ids_due:
+            order = orders_by_id.get(oid)
+            if order is None or order.get("статус") != "забронировано":
+                continue
+            if not order.get("истекает") or order["истекает"] > now:
+                continue
+            expired.append(order)
+        if not expired:
+            return
+
+        # одна запись на файл склада (основной и филиалы)
+        by_path = {}
+        for order in expired:
+            by_path.setdefault(order_stock_path(order), []).append(order)
+        for path, group in by_path.items():
+            deltas = {}
+            for order in group:
+                for f, q in (order.get("состав") or {}).items():
+                    deltas[f] = deltas.get(f, 0) + int(q)
+            apply_inventory_deltas(deltas, path=path, holders=[(lot_key(o), o["состав"]) for o in group])
+        for order in expired:
+            journal_order_stock("истечение брони", order, order["состав"])
+            with changing_order(order):
+                order["статус"] = "отменен, не собран"
+                order["возвращено"] = True
+
+
+expiry_scheduler = ExpiryScheduler(release_expired)
+
+
+# --------- предзаказы и календарь остатков ----------
+# по каждому цветку — префиксные суммы изменений по интервалам (поставки +, предзаказы −)
+# и суффиксный минимум; «хватит ли на пятницу 14:00» = остаток + минимум с этого интервала
+
+expected_deliveries = []
+
+
+class StockCalendar:
+
+    def __init__(self):
+        self.base = None
+        self.version = 0
+        self.rows = {}
+        self.prefix = np.zeros((0, self.size()), dtype=np.int64)
+        self.suffix_min = self.prefix.copy()
+
+    @staticmethod
+    def size():
+        return PROJECTION_HORIZON_DAYS * 24 * 60 // PROJECTION_BUCKET_MINUTES
+
+    @staticmethod
+    def current_base():
+        now = datetime.now().timestamp()
+        step = PROJECTION_BUCKET_MINUTES * 60
+        return now - now % step
+
+    def bucket(self, when):
+        if not when:
+            return 0
+        t = datetime.fromisoformat(when).timestamp()
+        return max(0, int((t - self.base) // (PROJECTION_BUCKET_MINUTES * 60)))
+
+    def in_horizon(self, when):
+        self.refresh()
+        return self.bucket(when) < self.size()
+
+    def _row(self, flower):
+        row = self.rows.get(flower)
+        if row is None:
+            row = self.rows[flower] = len(self.rows)
+            pad = np.zeros((1, self.size()), dtype=np.int64)
+            self.prefix = np.vstack([self.prefix, pad])
+            self.suffix_min = np.vstack([self.suffix_min, pad])
+        return row
+
+    def _apply(self, comp, when, sign):
+        if self.base is None:
+            return
+        b = self.bucket(when)
+        if b >= self.size():
+            return
+        self.version += 1
+        for f, q in comp.items():
+            row = self._row(f)
+            self.prefix[row, b:] += sign * int(q)
+            self.suffix_min[row] = np.minimum.accumulate(self.prefix[row, ::-1])[::-1]
+
+    def refresh(self):
+        # раз в интервал календарь пересобирается: прошедшие поставки и выданные заказы выпадают
+        base = self.current_base()
+        if base == self.base:
+            return
+        self.base = base
+        self.version += 1
+        self.rows = {}
+        self.prefix = np.zeros((0, self.size()), dtype=np.int64)
+        self.suffix_min = self.prefix.copy()
+        now = datetime.now().isoformat(timespec="seconds")
+        for order in orders:
+            self.add(order)
+        for d in expected_deliveries:
+            if d["время"] >= now:
+                self._apply({d["цветок"]: d["кол-во"]}, d["время"], 1)
+
+    def _tracked(self, order):
+        return order.get("отложено") and order.get("статус") in CONSUMING_STATUSES
+
+    def add(self, order):
+        if self._tracked(order):
+            self._apply(order["состав"], order["выдача"], -1)
+
+    def remove(self, order):
+        if self._tracked(order):
+            self._apply(order["состав"], order["выдача"], 1)
+
+    def add_delivery(self, flower, qty, when):
+        self.refresh()
+        self._apply({flower: qty}, when, 1)
+
+    def receive(self, flower, qty):
+        # фактическая приёмка закрывает ближайшие ожидаемые поставки этого цветка,
+        # иначе ранняя поставка учлась бы дважды: в остатке и в календаре.
+        # Пересборка — до правок списка: внутри цикла она вычла бы уже уменьшенное ещё раз
+        self.refresh()
+        now = datetime.now().isoformat(timespec="seconds")
+        pending = sorted((d for d in expected_deliveries if d["цветок"] == flower and d["время"] >= now), key=lambda d: d["время"])
+        for d in pending:
+            if qty <= 0:
+                break
+            take = min(d["кол-во"], qty)
+            d["кол-во"] -= take
+            qty -= take
+            self._apply({flower: take}, d["время"], -1)
+            if d["кол-во"] == 0:
+                expected_deliveries.remove(d)
+
+    def lowest(self, flower, when=None):
+        # минимум будущих изменений по цветку начиная с интервала when
+        self.refresh()
+        row = self.rows.get(flower)
+        if row is None:
+            return 0
+        return int(self.suffix_min[row, min(self.bucket(when), self.size() - 1)])
+
+    def shortages(self, comp, when, inventory):
+        missing = []
+        for f, q in comp.items():
+            if q <= 0:
+                continue
+            available = inventory.get(f, 0) + self.lowest(f, when)
+            if available < q:
+                missing.append(f"{f} (нужно {q}, будет {available})")
+        return missing
+
+
+stock_calendar = StockCalendar()
+order_listeners.append(stock_calendar)
+
+
+def materialize_due(order_ids_due):
+    # в момент выдачи предзаказ списывается со склада; каждый заказ — отдельно,
+    # чтобы нехватка по одному не оставила остальные несписанными
+    now = datetime.now().isoformat(timespec="seconds")
+    with excel_lock():
+        for oid in order_ids_due:
+            order = orders_by_id.get(oid)
+            if order is None or not order.get("отложено") or order["выдача"] > now:
+                continue
+            if order.get("статус") not in CONSUMING_STATUSES:
+                continue
+            deltas = {f: -q for f, q in order["состав"].items()}
+            try:
+                apply_inventory_deltas(deltas, holders=[(lot_key(order), deltas)])
+            except ValueError as e:
+                retry = (datetime.now() + timedelta(minutes=PICKUP_RETRY_MINUTES)).isoformat(timespec="seconds")
+                app.logger.warning("Предзаказ %s не списан (%s), повтор в %s", order["номер"], e, retry)
+                pickup_scheduler.schedule(retry, oid)
+                continue
+            journal_order_stock("выдача предзаказа", order, deltas)
+            with changing_order(order):
+                order["отложено"] = False
+
+
+pickup_scheduler = ExpiryScheduler(materialize_due)
+
+
+def edit_deferred_line(order, bouquet_idx, new_comp):
+    # предзаказ ещё не списан со склада: проверяется только календарь на момент выдачи
+    line = order['букеты'][bouquet_idx]
+    old_comp = line['состав']
+    extra = {f: new_comp.get(f, 0) - old_comp.get(f, 0) for f in set(old_comp) | set(new_comp)}
+    try:
+        inventory = load_data()[1]
+    except Exception:
+        inventory = {}
+    missing = stock_calendar.shortages(extra, order['выдача'], inventory)
+    if missing:
+        return missing
+    with changing_order(order):
+        line['состав'] = new_comp
+    return None
+
+
 # --------- HTML (UI) ----------
 HTML = '''
 <!doctype html>
@@ -388,8 +2182,12 @@ HTML = '''
 <a href="/excel" target="_blank">
   <button class="btn">База / Excel</button>
 </a>
+<a href="/picklist?format=html" target="_blank">
+  <button class="btn">Сборочный лист</button>
+</a>
 <form id="checkForm">
   <input type="text" name="bouquet" placeholder="Название букета" autofocus>
+  <input type="datetime-local" name="pickup" title="Время выдачи (для предзаказа)">
   <input type="submit" value="Проверить" class="btn">
 </form>
 
@@ -398,6 +2196,13 @@ HTML = '''
 <div id="container">
   <div style="flex:1;">
     <h2>Список заказов</h2>
+    <div id="bulkStatus">
+      <select id="bulkStatusValue">
+        {% for s in statuses %}<option value="{{ s }}">{{ s }}</option>{% endfor %}
+      </select>
+      <label><input type="checkbox" id="bulkReturn"> вернуть цветы на склад</label>
+      <button class="btn" id="bulkStatusBtn">Применить к отмеченным</button>
+    </div>
     <table id="ordersTable">
       <tr>
         <th class="small">номер</th>
@@ -406,79 +2211,25 @@ HTML = '''
         <th>Статус</th>
         <th>Действие</th>
       </tr>
-      {% for order in orders %}
-      <tr data-index="{{ loop.index0 }}">
-        <td class="small">
-          <input type="number" class="orderNumber" value="{{ order['номер'] }}" style="width:60px;">
-        </td>
+      {% for row in order_rows %}{{ row|safe }}{% endfor %}
+    </table>
+  </div>
 
-        <!-- Букеты: каждый с новой строки; редактируемое имя каждого букета -->
-        <td>
-          {% if order.get('букеты') %}
-            {% for b in order['букеты'] %}
-              <div class="bouquet-block" contenteditable="true" data-bouquet-index="{{ loop.index0 }}">{{ b['название'] }}</div>
-              {% if not loop.last %}<hr>{% endif %}
-            {% endfor %}
-          {% else %}
-            <div class="bouquet-block" contenteditable="true" data-bouquet-index="0">{{ order.get('букет','') }}</div>
-          {% endif %}
-        </td>
+  <div style="width:320px;">
+    <h2>Остатки на складе</h2>
+    <table id="inventoryTable" width="100%">
+      <tr><th>Цветок</th><th>Кол-во</th></tr>
+      {% for f, q in inventory.items() %}
+      <tr>
+        <td>{{ f }}</td>
+        <td class="inv-edit" contenteditable="true">{{ q }}</td>
+      </tr>
+      {% endfor %}
+    </table>
 
-        <!-- Состав: напротив каждого букета — его состав; каждый comp-block редактируем отдельно -->
-        <td>
-          {% if order.get('букеты') %}
-            {% for b in order['букеты'] %}
-              <div class="comp-block" data-bouquet-index="{{ loop.index0 }}" contenteditable="true">
-                {% for f, q in b['состав'].items() %}
-                  <div><span class="flower-name" contenteditable="false">{{ f }}</span>: <span class="qty-cell" contenteditable="true" data-flower="{{ f }}" data-bouquet-index="{{ loop.index0 }}">{{ q }}</span></div>
-                {% endfor %}
-                {% if b.get('shortage_text') %}
-                 <div style="margin-top:6px; color:#a00; font-size:13px;">
-                   {{ b['shortage_text'] }}
-                 </div>
-               {% endif %}
-                {% if b.get('replacements') or b.get('with_replacement') %}
-                  <div style="margin-top:6px;"><b>Замены (ручная правка)</b></div>
-                  {% for r in b.get('replacements', []) %}
-                    <div>{{ r['flower'] }}: {{ r['qty'] }}</div>
-                  {% endfor %}
-                {% endif %}
-              </div>
-              {% if not loop.last %}<hr>{% endif %}
-            {% endfor %}
-          {% else %}
-            {% for f, q in order.get('состав',{}).items() %}
-              <div><span class="flower-name" contenteditable="false">{{ f }}</span>: <span class="qty-cell" contenteditable="true" data-flower="{{ f }}" data-bouquet-index="0">{{ q }}</span></div>
-            {% endfor %}
-          {% endif %}
-        </td>
-
-        <td>
-  <select class="orderStatus" data-index="{{ loop.index0 }}">
-    <option value="забронировано" {% if order['статус']=="забронировано" %}selected{% endif %}>забронировано</option>
-    <option value="отменен, не собран" {% if order['статус']=="отменен, не собран" %}selected{% endif %}>отменен, не собран</option>
-    <option value="отменен, собран" {% if order['статус']=="отменен, собран" %}selected{% endif %}>отменен, собран</option>
-    <option value="оплачен, собран" {% if order['статус']=="оплачен, собран" %}selected{% endif %}>оплачен, собран</option>
-<option value="оплачен, не собран" {% if order['статус']=="оплачен, не собран" %}selected{% endif %}>оплачен, не собран</option>
-  </select>
-</td>
-        <td><button class="deleteBtn btn">Удалить</button></td>
-      </tr>
-      {% endfor %}
-    </table>
-  </div>
-
-  <div style="width:320px;">
-    <h2>Остатки на складе</h2>
-    <table id="inventoryTable" width="100%">
-      <tr><th>Цветок</th><th>Кол-во</th></tr>
-      {% for f, q in inventory.items() %}
-      <tr>
-        <td>{{ f }}</td>
-        <td class="inv-edit" contenteditable="true">{{ q }}</td>
-      </tr>
-      {% endfor %}
-    </table>
+    <h2>Приёмка поставки</h2>
+    <textarea id="deliveryLines" rows="6" style="width:100%;" placeholder="цветок: кол-во"></textarea>
+    <button class="btn" id="receiveBtn">Принять</button>
   </div>
 </div>
 
@@ -487,6 +2238,7 @@ HTML = '''
 window.tempOrder = window.tempOrder || [];
 window.currentReplacements = window.currentReplacements || [];
 window._lastInventory = window._lastInventory || {};
+window._stock = {version: null, data: {}};
 
 document.addEventListener('DOMContentLoaded', function() {
   const checkForm = document.getElementById('checkForm');
@@ -503,13 +2255,23 @@ window.tempOrder = tempOrder;
   headers: {'Content-Type': 'application/json'},
   body: JSON.stringify({
     bouquet: document.querySelector('[name="bouquet"]').value,
-    tempOrder: window.tempOrder || []
+    tempOrder: window.tempOrder || [],
+    compact: true
   })
 })
       .then(r => r.json())
+      .then(data => {
+        // полная таблица остатков запрашивается, только если склад изменился
+        if (data.версия === window._stock.version) return data;
+        return fetch('/stock').then(r => r.json()).then(s => {
+          window._stock = {version: s.версия, data: s.остатки || {}};
+          return data;
+        });
+      })
       .then(data => {
         
-        window._lastInventory = data.остатки || {};
+        data.остатки = Object.assign({}, window._stock.data, data.остатки || {});
+        window._lastInventory = data.остатки;
         let html = `<p><b>${data.букет}</b></p><p>Состав: `;
         for (let f in data.состав) html += `${f}: ${data.состав[f]} `;
         html += `</p>`;
@@ -522,6 +2284,8 @@ window.tempOrder = tempOrder;
         } else {
           
           html += `<button class="btn replacementBtn" data-bouquet="${(data.букет||'').replace(/"/g,'&quot;')}">Добавить с заменой в заказ</button>`;
+          html += `<div id="similarBouquets"></div>`;
+          showSimilar(data.букет);
         }
 
         
@@ -533,6 +2297,24 @@ window.tempOrder = tempOrder;
       });
   });
 
+  // похожие букеты, которые можно собрать сейчас, — вместо несобираемого
+  function showSimilar(name) {
+    fetch('/recommend?bouquet=' + encodeURIComponent(name))
+      .then(r => r.ok ? r.json() : null)
+      .then(data => {
+        const box = document.getElementById('similarBouquets');
+        if (!box || !data || !data.похожие.length) return;
+        let html = `<p><b>Можно предложить:</b></p><ul>`;
+        data.похожие.forEach(s => {
+          const attr = s.букет.replace(/"/g,'&quot;');
+          html += `<li>${s.букет} (есть на ${s.можно_собрать}) `;
+          html += `<button class="btn bookNowBtn" data-bouquet="${attr}">Забронировать</button> `;
+          html += `<button class="btn addBtn" data-bouquet="${attr}">Добавить в заказ</button></li>`;
+        });
+        box.innerHTML = html + `</ul>`;
+      }).catch(err => console.error(err));
+  }
+
   
   window.addToTemp = function(name){
     const fd = new FormData();
@@ -567,6 +2349,7 @@ window.tempOrder = tempOrder;
         }
         window.tempOrder = window.tempOrder || [];
         window.tempOrder.push({название: data.букет, состав: data.состав, with_replacement: false});
+        window._batchKey = null;
         if (typeof window.renderTemp === 'function') window.renderTemp();
       }).catch(err=>{ console.error(err); alert('Ошибка при добавлении в заказ'); });
   }
@@ -598,32 +2381,90 @@ window.tempOrder = tempOrder;
 
   window.removeTemp = function(i){
     window.tempOrder.splice(i,1);
+    window._batchKey = null;
     renderTemp();
   }
 
   window.clearTemp = function(){
     window.tempOrder = [];
+    window._batchKey = null;
     checkResultDiv.innerHTML = '';
   }
 
+  // бронирование с Idempotency-Key: при обрыве сети запрос повторяется с тем же ключом,
+  // и сервер не создаёт второй заказ; ключ живёт до перезагрузки страницы
+  function newIdempotencyKey() {
+    return (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : Date.now() + '-' + Math.random().toString(36).slice(2);
+  }
+
+  function isIdempotencyBusy(resp) {
+    return resp.status === 409 && resp.headers.has('Retry-After');
+  }
+
+  function postIdempotent(url, opts, key, tries) {
+    tries = tries || 3;
+    opts.headers = Object.assign({}, opts.headers || {}, {'Idempotency-Key': key});
+    const retry = () => new Promise(res => setTimeout(res, 1000)).then(() => postIdempotent(url, opts, key, tries - 1));
+    return fetch(url, opts).then(resp => {
+      // первый запрос с этим ключом ещё выполняется — ждём его результат
+      return (isIdempotencyBusy(resp) && tries > 1) ? retry() : resp;
+    }, err => {
+      if (tries <= 1) throw err;
+      return retry();
+    });
+  }
+
+  window._bookKeys = {};
+
   window.bookSingle = function(name){
     const fd = new FormData();
     fd.append('bouquet', name);
-    fetch('/book', {method:'POST', body: fd}).then(()=> location.reload());
+    const pickup = document.querySelector('[name="pickup"]').value;
+    if (pickup) fd.append('pickup', pickup);
+    const scope = name + '|' + pickup;
+    window._bookKeys[scope] = window._bookKeys[scope] || newIdempotencyKey();
+    postIdempotent('/book', {method:'POST', body: fd}, window._bookKeys[scope]).then(resp => {
+      if (isIdempotencyBusy(resp)) alert('Бронирование ещё выполняется, обновите страницу');
+      else if (resp.status === 409) alert('К этому времени цветов не хватит');
+      location.reload();
+    }).catch(err => { console.error(err); alert('Нет связи с сервером, повторите бронирование'); });
   }
 
   window.finalizeBatch = function(){
     if (!window.tempOrder || window.tempOrder.length === 0) return;
-    fetch('/book_batch', {
+    window._batchKey = window._batchKey || newIdempotencyKey();
+    postIdempotent('/book_batch', {
       method: 'POST',
       headers: {'Content-Type':'application/json'},
       body: JSON.stringify({bouquets: window.tempOrder})
-    }).then(resp => {
-      if (resp.ok) location.reload();
-      else resp.json().then(j => alert(j.error || 'Ошибка при бронировании'));
+    }, window._batchKey).then(resp => {
+      if (resp.ok) { location.reload(); return; }
+      // ответ с ошибкой сохранён под этим ключом: следующая попытка (например, после
+      // приёмки) должна идти с новым ключом, иначе вернётся та же ошибка
+      window._batchKey = null;
+      resp.json().then(j => alert(j.error || 'Ошибка при бронировании'));
     }).catch(err=>{ console.error(err); alert('Ошибка при финализации'); });
   }
 
+  // bulk status
+  document.getElementById('bulkStatusBtn').addEventListener('click', function(){
+    const ids = Array.from(document.querySelectorAll('.orderPick:checked')).map(cb => cb.closest('tr').dataset.id);
+    if (!ids.length) { alert('Отметьте заказы'); return; }
+    fetch('/orders/status', {
+      method:'POST',
+      headers:{'Content-Type':'application/json'},
+      body: JSON.stringify({
+        ids: ids,
+        status: document.getElementById('bulkStatusValue').value,
+        return_stock: document.getElementById('bulkReturn').checked
+      })
+    }).then(r => r.json()).then(j => {
+      if (j.error) alert(j.error);
+      else if (!j.ok) alert(j['заказы'].filter(r => !r.ok).map(r => r.id + ': ' + r['ошибка']).join('\\n'));
+      location.reload();
+    }).catch(err => { console.error(err); alert('Ошибка запроса'); });
+  });
+
   // delete
   document.querySelectorAll('.deleteBtn').forEach(btn=>{
     btn.addEventListener('click', function(){
@@ -715,6 +2556,9 @@ document.addEventListener('change', function(e) {
       method: 'POST',
       headers: {'Content-Type': 'application/json'},
       body: JSON.stringify({status: status})
+    }).then(r => {
+      if (r.status === 409) alert('Недостаточно на складе, чтобы вернуть бронь');
+      if (!r.ok) location.reload();
     });
   }
 });
@@ -733,6 +2577,22 @@ document.addEventListener('change', function(e) {
     });
   });
 
+  // delivery receiving: все строки одной поставкой
+  document.getElementById('receiveBtn').addEventListener('click', function(){
+    const lines = document.getElementById('deliveryLines').value.split('\\n')
+      .filter(s => s.includes(':'))
+      .map(s => { const [flower, qty] = s.split(':'); return {flower: flower.trim(), qty: parseInt(qty) || 0}; });
+    if (!lines.length) return;
+    fetch('/receive', {
+      method:'POST',
+      headers:{'Content-Type':'application/json'},
+      body: JSON.stringify({lines})
+    }).then(resp => {
+      if (resp.ok) location.reload();
+      else resp.json().then(j => alert((j.errors || []).map(e => e.error).join('\\n') || j.error));
+    }).catch(err => { console.error(err); alert('Ошибка запроса'); });
+  });
+
 }); // DOMContentLoaded
 
 // Делегирование кликов для динамических кнопок: replacementBtn, addBtn, bookNowBtn
@@ -893,76 +2753,264 @@ def check_order_with_data(name, bouquets, inventory):
     }
 
 
-def book_order_with_data(bouquet_name, bouquets, inventory):
+def book_order_with_data(bouquet_name, bouquets, inventory, ttl=None, branch=None):
     
     global next_order_id
     res = check_order_with_data(bouquet_name, bouquets, inventory)
     if res['статус'] != 'возможно':
         return None
-    recipe = res['состав'].copy()
+    recipe = res['состав']
+    if not branch and stock_calendar.shortages(recipe, None, inventory):
+        return None
     
-    for f, q in recipe.items():
-        inventory[f] = inventory.get(f, 0) - q
-    save_inventory(inventory)
-
-    order = {
-        "номер": next_order_id,
-        "букеты": [
-            {"название": bouquet_name, "состав": recipe.copy()}
-        ],
-        "букет": bouquet_name,
-        "состав": recipe.copy(),
-        "статус": "забронировано"
-    }
+    order = Order(
+        next_order_id,
+        [BouquetLine(bouquet_name, intern_recipe(bouquet_name, recipe))],
+        expires=reservation_deadline(ttl),
+        branch=branch
+    )
+    order.id = next(order_ids)
+    deltas = {f: -q for f, q in recipe.items()}
+    inventory.update(apply_inventory_deltas(deltas, path=order_stock_path(order), holders=[(lot_key(order), deltas)]))
     next_order_id += 1
-    orders.insert(0, order)
+    add_order(order)
+    journal_order_stock("бронь", order, deltas)
+    return order
+
+
+def schedule_order_with_data(bouquet_name, bouquets, inventory, pickup):
+    
+    global next_order_id
+    recipe = bouquets.get(norm(bouquet_name))
+    if recipe is None or stock_calendar.shortages(recipe, pickup, inventory):
+        return None
+    order = Order(next_order_id, [BouquetLine(bouquet_name, intern_recipe(bouquet_name, recipe))], pickup=pickup)
+    next_order_id += 1
+    add_order(order)
     return order
 
 
+# --------- строки заказов главной страницы ----------
+# строка заказа рендерится один раз на версию заказа (Order.touch при каждой правке);
+# номер строки в списке меняется с каждым новым заказом, поэтому в кэше на его месте
+# метка ORDER_ROW_INDEX — в экранированном тексте заказа «<» встретиться не может
+
+ORDER_ROW_HTML = '''
+      <tr data-index="{{ index }}" data-id="{{ order['id'] }}">
+        <td class="small">
+          <input type="checkbox" class="orderPick">
+          <input type="number" class="orderNumber" value="{{ order['номер'] }}" style="width:60px;">
+          {% if order.get('филиал') %}<div style="font-size:12px; color:#666;">{{ order['филиал'] }}</div>{% endif %}
+        </td>
+
+        <!-- Букеты: каждый с новой строки; редактируемое имя каждого букета -->
+        <td>
+          {% if order.get('букеты') %}
+            {% for b in order['букеты'] %}
+              <div class="bouquet-block" contenteditable="true" data-bouquet-index="{{ loop.index0 }}">{{ b['название'] }}</div>
+              {% if not loop.last %}<hr>{% endif %}
+            {% endfor %}
+          {% else %}
+            <div class="bouquet-block" contenteditable="true" data-bouquet-index="0">{{ order.get('букет','') }}</div>
+          {% endif %}
+        </td>
+
+        <!-- Состав: напротив каждого букета — его состав; каждый comp-block редактируем отдельно -->
+        <td>
+          {% if order.get('букеты') %}
+            {% for b in order['букеты'] %}
+              <div class="comp-block" data-bouquet-index="{{ loop.index0 }}" contenteditable="true">
+                {% for f, q in b['состав'].items() %}
+                  <div><span class="flower-name" contenteditable="false">{{ f }}</span>: <span class="qty-cell" contenteditable="true" data-flower="{{ f }}" data-bouquet-index="{{ loop.index0 }}">{{ q }}</span></div>
+                {% endfor %}
+                {% if b.get('shortage_text') %}
+                 <div style="margin-top:6px; color:#a00; font-size:13px;">
+                   {{ b['shortage_text'] }}
+                 </div>
+               {% endif %}
+                {% if b.get('replacements') or b.get('with_replacement') %}
+                  <div style="margin-top:6px;"><b>Замены (ручная правка)</b></div>
+                  {% for r in b.get('replacements', []) %}
+                    <div>{{ r['flower'] }}: {{ r['qty'] }}</div>
+                  {% endfor %}
+                {% endif %}
+              </div>
+              {% if not loop.last %}<hr>{% endif %}
+            {% endfor %}
+          {% else %}
+            {% for f, q in order.get('состав',{}).items() %}
+              <div><span class="flower-name" contenteditable="false">{{ f }}</span>: <span class="qty-cell" contenteditable="true" data-flower="{{ f }}" data-bouquet-index="0">{{ q }}</span></div>
+            {% endfor %}
+          {% endif %}
+        </td>
+
+        <td>
+  <select class="orderStatus" data-index="{{ index }}">
+    <option value="забронировано" {% if order['статус']=="забронировано" %}selected{% endif %}>забронировано</option>
+    <option value="отменен, не собран" {% if order['статус']=="отменен, не собран" %}selected{% endif %}>отменен, не собран</option>
+    <option value="отменен, собран" {% if order['статус']=="отменен, собран" %}selected{% endif %}>отменен, собран</option>
+    <option value="оплачен, собран" {% if order['статус']=="оплачен, собран" %}selected{% endif %}>оплачен, собран</option>
+<option value="оплачен, не собран" {% if order['статус']=="оплачен, не собран" %}selected{% endif %}>оплачен, не собран</option>
+  </select>
+  {% if order.get('выдача') %}
+    <div style="font-size:12px; color:#666;">выдача {{ order['выдача'][:16]|replace('T', ' ') }}{% if order.get('отложено') %} (не списан){% endif %}</div>
+  {% endif %}
+  {% if order.get('истекает') and order['статус']=="забронировано" %}
+    <div style="font-size:12px; color:#666;">бронь до {{ order['истекает'][11:16] }}</div>
+  {% elif order.get('возвращено') %}
+    <div style="font-size:12px; color:#666;">бронь снята, цветы на складе</div>
+  {% endif %}
+</td>
+        <td><button class="deleteBtn btn">Удалить</button></td>
+      </tr>
+'''
+
+ORDER_ROW_INDEX = "<#>"
+order_row_cache = LRUCache(ORDER_ROW_CACHE_SIZE)
+_order_row_template = None
+
+
+def render_order_row(order):
+    global _order_row_template
+    key = (order["id"], order.version)
+    fragment = order_row_cache.get(key)
+    if fragment is None:
+        if _order_row_template is None:
+            _order_row_template = app.jinja_env.from_string(ORDER_ROW_HTML)
+        fragment = _order_row_template.render(order=order, index=Markup(ORDER_ROW_INDEX))
+        order_row_cache.put(key, fragment)
+    return fragment
+
+
 @app.route("/")
 def index():
     try:
         bouquets, inventory = load_data()
     except Exception:
         bouquets, inventory = {}, {}
-    
-    for o in orders:
-        ensure_order_buckets(o)
-    return render_template_string(HTML, orders=orders, inventory=inventory)
+    rows = [render_order_row(order).replace(ORDER_ROW_INDEX, str(i)) for i, order in enumerate(orders)]
+    return render_template_string(HTML, order_rows=rows, inventory=inventory, statuses=ORDER_STATUSES)
+
+
+check_cache = LRUCache(CHECK_CACHE_SIZE)
 
 
 @app.route("/check", methods=["POST"])
 def check():
-    try:
-        bouquets, inventory = load_data()
-    except Exception:
-        return jsonify({"букет": "", "состав": {}, "статус": "ошибка", "сообщение": "Ошибка чтения Excel"}), 500
-
     
     if request.is_json:
         data = request.get_json() or {}
         name = (data.get("bouquet") or "").strip()
         temp = data.get("tempOrder", [])
+        branch = data.get("branch")
     else:
         name = request.form.get("bouquet", "").strip()
         temp = []
+        branch = request.form.get("branch")
+
+    branch = parse_branch(branch)
+    if branch is False:
+        return jsonify({"букет": name, "состав": {}, "статус": "ошибка", "сообщение": "Неизвестный филиал"}), 404
+
+    # результат зависит только от версии склада, календаря предзаказов, букета и корзины
+    stock_calendar.refresh()
+    version = check_stock_version(branch)
+    cart = hashlib.sha1(json.dumps(temp, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    cache_key = (version, stock_calendar.version, norm(name), cart)
+    cached = check_cache.get(cache_key)
+    if cached is None:
+        try:
+            cached = check_with_cart(name, temp, branch)
+        except Exception:
+            return jsonify({"букет": "", "состав": {}, "статус": "ошибка", "сообщение": "Ошибка чтения Excel"}), 500
+        check_cache.put(cache_key, cached)
+    result, touched = cached
+    if result["букет"] != name:
+        result = dict(result, букет=name)
+
+    # compact: только цветы рецепта и корзины + версия склада; полная таблица — GET /stock
+    if request.is_json and data.get("compact"):
+        result = dict(result)
+        result["остатки"] = {f: result["остатки"][f] for f in touched if f in result["остатки"]}
+        result["версия"] = version
+    return jsonify(result)
 
-    
-    inv_copy = inventory.copy()
+
+def check_stock_version(branch=None):
+    version = stock_version()
+    return f"{version}/{stock_version(branch_file(branch))}" if branch else version
+
+
+def check_with_cart(name, temp, branch):
+    # (результат проверки, цветы рецепта и корзины)
+    bouquets, inventory = load_branch_data(branch)
+    registry = flower_registry(branch_file(branch) if branch else None)
+
+    # корзина суммируется по id цветов; составы от клиента приводятся к колонкам книги,
+    # неизвестные цветы склад не трогают
+    cart = np.zeros(len(registry), dtype=np.int64)
     for item in temp:
         if isinstance(item, dict):
             comp = item.get('состав') or {}
-            for f, q in comp.items():
-                inv_copy[f] = inv_copy.get(f, 0) - int(q)
         else:
-            key = norm(item)
-            if key in bouquets:
-                for f, q in bouquets[key].items():
-                    inv_copy[f] = inv_copy.get(f, 0) - int(q)
+            comp = bouquets.get(norm(item), {})
+        cart += registry.vector(comp)
+    inv_copy = inventory.copy()
+    touched = set()
+    for i in np.flatnonzero(cart):
+        f = registry.names[i]
+        inv_copy[f] = inv_copy.get(f, 0) - int(cart[i])
+        touched.add(f)
 
     result = check_order_with_data(name, bouquets, inv_copy)
+    touched.update(result["состав"])
+    if result["статус"] == "возможно" and not branch:
+        missing = stock_calendar.shortages(result["состав"], None, inv_copy)
+        if missing:
+            result["статус"] = "ошибка"
+            result["сообщение"] = "Цветы отложены под предзаказы:\n" + ", ".join(missing)
     result["остатки"] = inv_copy
-    return jsonify(result)
+    return result, touched
+
+
+@app.route("/stock")
+def stock():
+    branch = parse_branch(request.args.get("branch"))
+    if branch is False:
+        return jsonify({"error": "Неизвестный филиал"}), 404
+    version = check_stock_version(branch)
+    try:
+        inventory = load_branch_data(branch)[1]
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+    return jsonify({"версия": version, "остатки": inventory})
+
+
+@app.after_request
+def compress_response(response):
+    # сжатие крупных JSON-ответов по Accept-Encoding; потоковые ответы не трогаем
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code >= 300 or "Content-Encoding" in response.headers
+            or response.mimetype != "application/json"):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        response.set_data(brotli.compress(body))
+        response.headers["Content-Encoding"] = "br"
+    elif accepted["gzip"]:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        return response
+    response.headers.add("Vary", "Accept-Encoding")
+    # у сжатого представления свой ETag (см. catalog_not_modified)
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{response.headers['Content-Encoding']}", weak)
+    return response
 
 @app.route("/apply_temp_inventory", methods=["POST"])
 def apply_temp_inventory():
@@ -973,17 +3021,153 @@ def apply_temp_inventory():
         temp_inventory[f] = temp_inventory.get(f, 0) - q
     return jsonify({"ok": True})
 
+# --------- идемпотентность бронирований ----------
+
+class IdempotencyStore:
+
+    def __init__(self, path, ttl, max_keys, pending):
+        self.path = path
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.pending = pending
+        self.ready = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self.ready:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, digest TEXT, created REAL,"
+                " status INTEGER, mimetype TEXT, body BLOB)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS keys_created ON keys (created)")
+            self.ready = True
+        return conn
+
+    def claim(self, key, digest):
+        # ("new", None) — выполнять; ("done", (код, тип, тело)) — отдать сохранённое;
+        # ("busy", None) — тот же запрос ещё выполняется; ("mismatch", None) — ключ от другого запроса
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM keys WHERE created < ?", (now - self.ttl,))
+            row = conn.execute(
+                "SELECT digest, created, status, mimetype, body FROM keys WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO keys (key, digest, created) VALUES (?, ?, ?)", (key, digest, now))
+                conn.execute(
+                    "DELETE FROM keys WHERE key IN (SELECT key FROM keys ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_keys,)
+                )
+                result = ("new", None)
+            elif row[0] != digest:
+                result = ("mismatch", None)
+            elif row[2] is not None:
+                result = ("done", (row[2], row[3], row[4]))
+            elif row[1] > now - self.pending:
+                result = ("busy", None)
+            else:
+                conn.execute("UPDATE keys SET created = ? WHERE key = ?", (now, key))
+                result = ("new", None)
+            conn.execute("COMMIT")
+            return result
+        finally:
+            conn.close()
+
+    def finish(self, key, status, mimetype, body):
+        conn = self.connect()
+        try:
+            conn.execute("UPDATE keys SET status = ?, mimetype = ?, body = ? WHERE key = ?", (status, mimetype, body, key))
+        finally:
+            conn.close()
+
+    def release(self, key):
+        # сбой сервера не запоминается: повтор с тем же ключом выполнится заново
+        conn = self.connect()
+        try:
+            conn.execute("DELETE FROM keys WHERE key = ? AND status IS NULL", (key,))
+        finally:
+            conn.close()
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_DB, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_PENDING_SECONDS)
+
+
+def idempotency_payload():
+    # тело в каноническом виде: у FormData при каждом fetch новая граница multipart,
+    # у JSON может меняться порядок ключей и пробелы
+    if request.is_json:
+        return json.dumps(request.get_json(silent=True), sort_keys=True, ensure_ascii=False).encode()
+    if request.mimetype in ("multipart/form-data", "application/x-www-form-urlencoded"):
+        return json.dumps(sorted(request.form.items(multi=True)), ensure_ascii=False).encode()
+    return request.get_data()
+
+
+def idempotent(fn):
+    # повтор с тем же Idempotency-Key получает исходный ответ, а не второй заказ
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key", "").strip()
+        if not key:
+            return fn(*args, **kwargs)
+        if len(key) > 200:
+            return jsonify({"error": "Слишком длинный Idempotency-Key"}), 400
+        key = f"{request.path}:{key}"
+        digest = hashlib.sha1(idempotency_payload()).hexdigest()
+
+        state, saved = idempotency_store.claim(key, digest)
+        if state == "done":
+            resp = Response(saved[2], status=saved[0], mimetype=saved[1])
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+        if state == "busy":
+            # Retry-After отличает «ещё выполняется» от 409 самих маршрутов
+            resp = jsonify({"error": "Запрос с этим ключом ещё выполняется"})
+            resp.status_code = 409
+            resp.headers["Retry-After"] = "1"
+            return resp
+        if state == "mismatch":
+            return jsonify({"error": "Ключ уже использован для другого запроса"}), 422
+
+        try:
+            resp = app.make_response(fn(*args, **kwargs))
+        except Exception:
+            idempotency_store.release(key)
+            raise
+        if resp.status_code >= 500:
+            idempotency_store.release(key)
+        else:
+            idempotency_store.finish(key, resp.status_code, resp.mimetype, resp.get_data())
+        return resp
+    return wrapper
+
+
 @app.route("/book", methods=["POST"])
+@idempotent
 def book():
     name = request.form.get("bouquet", "")
-    try:
-        bouquets, inventory = load_data()
-    except:
-        return '', 500
-    book_order_with_data(name, bouquets, inventory)
+    branch = parse_branch(request.form.get("branch"))
+    if branch is False:
+        return '', 404
+    pickup = parse_pickup(request.form.get("pickup"))
+    if pickup is False or (pickup and branch):
+        return '', 400
+    # проверка остатков и списание — под одной блокировкой, иначе два букета
+    # могут занять последние цветы одновременно
+    with excel_lock():
+        try:
+            bouquets, inventory = load_branch_data(branch)
+        except:
+            return '', 500
+        if pickup:
+            order = schedule_order_with_data(name, bouquets, inventory, pickup)
+            return ('', 204) if order else ('', 409)
+        book_order_with_data(name, bouquets, inventory, request.form.get("ttl"), branch)
     return '', 204
 
 @app.route("/book_batch", methods=["POST"])
+@idempotent
 def book_batch():
     global next_order_id
 
@@ -991,89 +3175,104 @@ def book_batch():
     items = data if isinstance(data, list) else data.get("bouquets", [])
     if not items:
         return jsonify({"error":"Пустой список букетов"}), 400
+    branch = None if isinstance(data, list) else parse_branch(data.get("branch"))
+    if branch is False:
+        return jsonify({"error": "Неизвестный филиал"}), 404
 
-    try:
-        bouquets, inventory = load_data()
-    except Exception:
-        return jsonify({"error":"Ошибка чтения Excel"}), 500
-
-    prepared = []
-    for it in items:
-        if isinstance(it, dict):
-            name = it.get('название') or it.get('букет') or 'без имени'
-            comp = {str(k): int(v) for k, v in (it.get('состав') or {}).items()}
-            with_repl = bool(it.get('with_replacement', False))
-        else:
-            name = it
-            key = norm(name)
-            if key not in bouquets:
-                return jsonify({"error": f"Неизвестный букет: {name}"}), 400
-            comp = bouquets[key].copy()
-            with_repl = False
-        prepared.append({"название": name, "состав": comp, "with_replacement": with_repl})
-
-    total_needed = {}
-    for p in prepared:
-        if not p["with_replacement"]:
-            for f, q in p["состав"].items():
-                total_needed[f] = total_needed.get(f, 0) + int(q)
+    # чтение, проверка и списание — под одной блокировкой
+    with excel_lock():
+        try:
+            bouquets, inventory = load_branch_data(branch)
+            registry = flower_registry(branch_file(branch) if branch else None)
+        except Exception:
+            return jsonify({"error":"Ошибка чтения Excel"}), 500
+
+        prepared = []
+        for it in items:
+            if isinstance(it, dict):
+                name = it.get('название') or it.get('букет') or 'без имени'
+                # состав от клиента приводится к колонкам книги, как в /check
+                comp, unknown = registry.resolve({k: int(v) for k, v in (it.get('состав') or {}).items()})
+                if unknown:
+                    return jsonify({"error": "Неизвестные цветы: " + ", ".join(unknown)}), 400
+                with_repl = bool(it.get('with_replacement', False))
+            else:
+                name = it
+                key = norm(name)
+                if key not in bouquets:
+                    return jsonify({"error": f"Неизвестный букет: {name}"}), 400
+                comp = bouquets[key].copy()
+                with_repl = False
+            prepared.append({"название": name, "состав": comp, "with_replacement": with_repl})
+
+        total_needed = {}
+        for p in prepared:
+            if not p["with_replacement"]:
+                for f, q in p["состав"].items():
+                    total_needed[f] = total_needed.get(f, 0) + int(q)
     
-    for f, q in total_needed.items():
-        if inventory.get(f, 0) < q:
-            return jsonify({"error": f"Недостаточно {f} (осталось {inventory.get(f,0)})"}), 400
-    for f, q in total_needed.items():
-        inventory[f] = inventory.get(f, 0) - q
-
-    for p in prepared:
-        if p["with_replacement"]:
-            comp = p.get("состав") or {}
-            if not comp:
-                key = norm(p["название"].replace(" (с заменой)", ""))  
-                comp = bouquets.get(key, {}).copy()
+        for f, q in total_needed.items():
+            if inventory.get(f, 0) < q:
+                return jsonify({"error": f"Недостаточно {f} (осталось {inventory.get(f,0)})"}), 400
+        missing = [] if branch else stock_calendar.shortages(total_needed, None, inventory)
+        if missing:
+            return jsonify({"error": "Не хватит для предзаказов: " + ", ".join(missing)}), 400
+        for f, q in total_needed.items():
+            inventory[f] = inventory.get(f, 0) - q
 
-    allocated = {}
-    shortage = []
+        for p in prepared:
+            if not p["with_replacement"]:
+                continue
+            comp = p.get("состав") or bouquets.get(norm(base_bouquet_name(p["название"])), {})
 
-    for f, need in comp.items():
-        need_i = int(need)
-        avail = inventory.get(f, 0)
+            allocated = {}
+            shortage = []
 
-        take = min(need_i, avail) if need_i > 0 else 0
+            for f, need in comp.items():
+                need_i = int(need)
+                avail = inventory.get(f, 0)
 
-        allocated[f] = take
+                take = min(need_i, avail) if need_i > 0 else 0
 
-        inventory[f] = inventory.get(f, 0) - take
-        if take < need_i:
-            shortage.append(f"{f}: нужно {need_i}, есть {take}")
+                allocated[f] = take
 
+                inventory[f] = inventory.get(f, 0) - take
+                if take < need_i:
+                    shortage.append(f"{f}: нужно {need_i}, есть {take}")
 
-    p["состав"] = allocated
-    if shortage:
-        p["shortage_text"] = "; ".join(shortage)
+            p["состав"] = allocated
+            if shortage:
+                p["shortage_text"] = "; ".join(shortage)
 
-    try:
-        save_inventory(inventory)
-    except Exception as e:
-        return jsonify({"error": "Ошибка записи Excel: " + str(e)}), 500
+        lines = []
+        for p in prepared:
+            line = BouquetLine.build(p["название"], p["состав"], bouquets, p["with_replacement"])
+            line.shortage_text = p.get("shortage_text")
+            lines.append(line)
+        order = Order(
+            next_order_id,
+            lines,
+            expires=reservation_deadline(None if isinstance(data, list) else data.get("ttl")),
+            branch=branch
+        )
+        order.id = next(order_ids)
 
-    
-    order = {
-        "номер": next_order_id,
-        "букеты": prepared,
-        "букет": ", ".join([p['название'] for p in prepared]),
-        "состав": {}, 
-        "статус": "забронировано"
-    }
-    
-    total = {}
-    for p in prepared:
-        for f, q in (p.get("состав") or {}).items():
-            total[f] = total.get(f, 0) + int(q)
-    order["состав"] = total
+        deltas = {}
+        for p in prepared:
+            for f, q in p["состав"].items():
+                if int(q):
+                    deltas[f] = deltas.get(f, 0) - int(q)
+        try:
+            apply_inventory_deltas(deltas, path=order_stock_path(order), holders=[(lot_key(order), deltas)])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": "Ошибка записи Excel: " + str(e)}), 500
 
-    next_order_id += 1
-    orders.insert(0, order)
-    return jsonify(order), 201
+        next_order_id += 1
+        add_order(order)
+        journal_order_stock("бронь", order, deltas)
+        return jsonify(order.to_dict()), 201
 
 @app.route("/edit_order_number/<int:index>", methods=["POST"])
 def edit_order_number(index):
@@ -1083,28 +3282,23 @@ def edit_order_number(index):
     except:
         return '', 400
     if 0 <= index < len(orders):
-        orders[index]['номер'] = new_num
+        with changing_order(orders[index]) as order:
+            order['номер'] = new_num
         return '', 204
     return '', 400
 
 
 @app.route("/delete/<int:index>", methods=["POST"])
 def delete_order(index):
-    if 0 <= index < len(orders):
-        try:
-            bouquets, inventory = load_data()
-        except:
-            inventory = {}
-        
-        if 'букеты' in orders[index]:
-            for b in orders[index]['букеты']:
-                for f, q in b['состав'].items():
-                    inventory[f] = inventory.get(f, 0) + q
-        else:
-            for f, q in orders[index]['состав'].items():
-                inventory[f] = inventory.get(f, 0) + q
-        save_inventory(inventory)
-        orders.pop(index)
+    with excel_lock():
+        if 0 <= index < len(orders):
+            if not (orders[index].get("отложено") or orders[index].get("возвращено")):
+                try:
+                    apply_inventory_deltas(orders[index]['состав'], path=order_stock_path(orders[index]), holders=[(lot_key(orders[index]), orders[index]['состав'])])
+                except:
+                    return '', 500
+                journal_order_stock("удаление заказа", orders[index], orders[index]['состав'])
+            pop_order(index)
     return '', 204
 
 
@@ -1122,17 +3316,13 @@ def edit_order(index):
         return '', 400
 
     order = orders[index]
-    if 'букеты' in order:
-        if bouquet_idx is None:
-            if len(order['букеты']) == 1 and new_name:
-                order['букеты'][0]['название'] = new_name
-        else:
-            if 0 <= bouquet_idx < len(order['букеты']) and new_name:
-                order['букеты'][bouquet_idx]['название'] = new_name
-        recompute_order_summary(order)
-    else:
-        if new_name:
-            order['букет'] = new_name
+    if bouquet_idx is None and len(order['букеты']) == 1:
+        bouquet_idx = 0
+    if not new_name or bouquet_idx is None or not (0 <= bouquet_idx < len(order['букеты'])):
+        return '', 204
+    with changing_order(order):
+        order['букеты'][bouquet_idx]['название'] = new_name
+        order.touch()
     return '', 204
 
 
@@ -1144,15 +3334,83 @@ def edit_inventory(flower):
         new_qty = int(data.get("new_qty"))
     except:
         return '', 400
-    try:
-        bouquets, inventory = load_data()
-    except:
-        inventory = {}
-    inventory[flower] = new_qty
-    save_inventory(inventory)
+    branch = parse_branch(data.get("branch"))
+    if branch is False:
+        return '', 404
+    path = branch_file(branch) if branch else None
+    flower = flower_registry(path).canonical(flower)
+    if flower is None:
+        return '', 404
+    # пишется только этот цветок: остальные остатки перечитываются под блокировкой
+    save_inventory({flower: new_qty}, path)
     return '', 204
 
 
+@app.route("/receive", methods=["POST"])
+def receive_delivery():
+    
+    data = request.get_json(silent=True) or {}
+    lines = data.get("lines") or []
+    if not isinstance(lines, list) or not lines:
+        return jsonify({"error": "Пустая поставка"}), 400
+    branch = parse_branch(data.get("branch"))
+    if branch is False:
+        return jsonify({"error": "Неизвестный филиал"}), 404
+
+    try:
+        known = flower_registry(branch_file(branch) if branch else None)
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+
+    deltas = {}
+    vase_life = {}
+    errors = []
+    for i, line in enumerate(lines):
+        if not isinstance(line, dict):
+            errors.append({"line": i, "error": "ожидался объект {flower, qty}"})
+            continue
+        flower, qty, err = parse_stock_record(line, known)
+        if err is None and qty <= 0:
+            err = f"количество должно быть больше нуля: {line.get('flower')}"
+        if err:
+            errors.append({"line": i, "error": err})
+            continue
+        deltas[flower] = deltas.get(flower, 0) + qty
+        if line.get("vase_life") is not None:
+            try:
+                vase_life[flower] = max(1, int(line["vase_life"]))
+            except (TypeError, ValueError):
+                errors.append({"line": i, "error": f"некорректный vase_life: {line['vase_life']}"})
+    if errors:
+        return jsonify({"error": "Поставка не принята", "errors": errors}), 400
+
+    try:
+        with excel_lock():
+            if branch:
+                result = apply_inventory_deltas(deltas, path=branch_file(branch))
+                journal("поставка", поставщик=data.get("supplier") or "", филиал=branch, строки=deltas)
+            else:
+                result = apply_inventory_deltas(deltas, vase_life)
+                journal("поставка", поставщик=data.get("supplier") or "", строки=deltas)
+                for f, q in deltas.items():
+                    stock_calendar.receive(f, q)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": "Ошибка записи Excel: " + str(e)}), 500
+    return jsonify({"ok": True, "остатки": result})
+
+
+@app.route("/lots/expiring")
+def lots_expiring():
+    try:
+        days = int(request.args.get("days", 2))
+    except ValueError:
+        return jsonify({"error": "days должен быть числом"}), 400
+    until = (datetime.now().date() + timedelta(days=days)).isoformat()
+    return jsonify({"до": until, "партии": lot_store.expiring(until)})
+
+
 @app.route("/edit_order_qty/<int:index>", methods=["POST"])
 def edit_order_qty(index):
     
@@ -1167,44 +3425,37 @@ def edit_order_qty(index):
     except:
         bouquet_idx = 0
 
-    if not (0 <= index < len(orders)):
-        return '', 400
-
-    try:
-        bouquets, inventory = load_data()
-    except:
-        inventory = {}
-
-    order = orders[index]
-    
-    if 'букеты' in order:
+    with excel_lock():
+        if not (0 <= index < len(orders)):
+            return '', 400
+        order = orders[index]
         if not (0 <= bouquet_idx < len(order['букеты'])):
             return '', 400
         comp = order['букеты'][bouquet_idx]['состав']
-        if flower not in comp:
+        if flower not in comp or order.get("возвращено"):
             return '', 400
-        old_qty = comp[flower]
-        diff = new_qty - old_qty
-        if inventory.get(flower, 0) - diff < 0:
-            return '', 400
-        comp[flower] = new_qty
-        
-        recompute_order_summary(order)
-        inventory[flower] = inventory.get(flower, 0) - diff
-        save_inventory(inventory)
-        return '', 204
-    else:
-        
-        if flower not in order['состав']:
-            return '', 400
-        old_qty = order['состав'][flower]
-        diff = new_qty - old_qty
-        if inventory.get(flower, 0) - diff < 0:
+        if order.get("отложено"):
+            comp[flower] = new_qty
+            return ('', 400) if edit_deferred_line(order, bouquet_idx, comp) else ('', 204)
+        diff = new_qty - comp[flower]
+        if diff > 0 and not order.get("филиал"):
+            try:
+                inventory = load_data()[1]
+            except:
+                return '', 500
+            if stock_calendar.shortages({flower: diff}, None, inventory):
+                return '', 400
+        try:
+            apply_inventory_deltas({flower: -diff}, path=order_stock_path(order), holders=[(lot_key(order), {flower: -diff})])
+        except ValueError:
             return '', 400
-        order['состав'][flower] = new_qty
-        inventory[flower] = inventory.get(flower, 0) - diff
-        save_inventory(inventory)
-        return '', 204
+        except:
+            return '', 500
+        journal_order_stock("правка заказа", order, {flower: -diff})
+        with changing_order(order):
+            comp[flower] = new_qty
+            order['букеты'][bouquet_idx]['состав'] = comp
+    return '', 204
 
 
 @app.route("/edit_order_composition/<int:index>", methods=["POST"])
@@ -1217,14 +3468,6 @@ def edit_order_composition(index):
     except:
         bouquet_idx = 0
 
-    if not (0 <= index < len(orders)):
-        return jsonify({"status":"ошибка","message":"Неверный индекс заказа"}), 400
-
-    try:
-        bouquets, inventory = load_data()
-    except:
-        return jsonify({"status":"ошибка","message":"Ошибка чтения Excel"}), 500
-
     
     new_comp = {}
     for line in new_text.splitlines():
@@ -1239,66 +3482,1207 @@ def edit_order_composition(index):
         if qty > 0:
             new_comp[flower] = qty
 
-    order = orders[index]
-    
-    if 'букеты' in order:
+    with excel_lock():
+        if not (0 <= index < len(orders)):
+            return jsonify({"status":"ошибка","message":"Неверный индекс заказа"}), 400
+        order = orders[index]
         if not (0 <= bouquet_idx < len(order['букеты'])):
             return jsonify({"status":"ошибка","message":"Неверный индекс букета в заказе"}), 400
+        if order.get("возвращено"):
+            return jsonify({"status":"ошибка","message":"Бронь снята, цветы уже на складе"}), 400
+        try:
+            new_comp, unknown = flower_registry(order_stock_path(order)).resolve(new_comp)
+        except Exception:
+            return jsonify({"status":"ошибка","message":"Ошибка чтения Excel"}), 500
+        if unknown:
+            return jsonify({"status":"ошибка","message":"Неизвестные цветы: " + ", ".join(unknown)}), 400
+        if order.get("отложено"):
+            missing = edit_deferred_line(order, bouquet_idx, new_comp)
+            if missing:
+                return jsonify({"status":"ошибка","message":"Не хватит к выдаче: " + ", ".join(missing)}), 400
+            return '', 204
         old_comp = order['букеты'][bouquet_idx]['состав']
-        
-        for f, q in old_comp.items():
-            inventory[f] = inventory.get(f, 0) + q
-        
-        for f, q in new_comp.items():
-            if inventory.get(f, 0) < q:
-                
-                for f2, q2 in old_comp.items():
-                    inventory[f2] = inventory.get(f2, 0) - q2
-                return jsonify({"status":"ошибка","message":f"Недостаточно {f} (осталось {inventory.get(f,0)})"}), 400
-       
-        for f, q in new_comp.items():
-            inventory[f] = inventory.get(f, 0) - q
-        order['букеты'][bouquet_idx]['состав'] = new_comp
-        recompute_order_summary(order)
-        save_inventory(inventory)
-        return '', 204
-    else:
-        
-        old_comp = order['состав']
-        for f, q in old_comp.items():
-            inventory[f] = inventory.get(f, 0) + q
-        for f, q in new_comp.items():
-            if inventory.get(f, 0) < q:
-                for f2, q2 in old_comp.items():
-                    inventory[f2] = inventory.get(f2, 0) - q2
-                return jsonify({"status":"ошибка","message":f"Недостаточно {f} (осталось {inventory.get(f,0)})"}), 400
-        for f, q in new_comp.items():
-            inventory[f] = inventory.get(f, 0) - q
-        order['состав'] = new_comp
-        save_inventory(inventory)
-        return '', 204
+        # старый состав возвращается на склад, новый списывается — одной записью
+        deltas = {}
+        for f in set(old_comp) | set(new_comp):
+            d = old_comp.get(f, 0) - new_comp.get(f, 0)
+            if d:
+                deltas[f] = d
+        extra = {f: -d for f, d in deltas.items() if d < 0}
+        if extra and not order.get("филиал"):
+            try:
+                inventory = load_data()[1]
+            except Exception:
+                return jsonify({"status":"ошибка","message":"Ошибка чтения Excel"}), 500
+            missing = stock_calendar.shortages(extra, None, inventory)
+            if missing:
+                return jsonify({"status":"ошибка","message":"Не хватит для предзаказов: " + ", ".join(missing)}), 400
+        try:
+            apply_inventory_deltas(deltas, path=order_stock_path(order), holders=[(lot_key(order), deltas)])
+        except ValueError as e:
+            return jsonify({"status":"ошибка","message":str(e)}), 400
+        except Exception:
+            return jsonify({"status":"ошибка","message":"Ошибка записи Excel"}), 500
+        journal_order_stock("правка заказа", order, deltas)
+        with changing_order(order):
+            order['букеты'][bouquet_idx]['состав'] = new_comp
+    return '', 204
 
 @app.route("/edit_order_status/<int:index>", methods=["POST"])
 def edit_order_status(index):
     data = request.get_json() or {}
     new_status = data.get("status")
 
-    allowed = [
-        "забронировано",
-        "отменен, не собран",
-        "отменен, собран",
-        "оплачен, собран",
-        "оплачен, не собран"
+    if new_status not in ORDER_STATUSES:
+        return '', 400
+
+    with excel_lock():
+        if not (0 <= index < len(orders)):
+            return '', 400
+        order = orders[index]
+        # снятую бронь вернули в работу — цветы списываются заново, срок брони снимается
+        restore = order.get("возвращено") and new_status in CONSUMING_STATUSES
+        if restore:
+            deltas = {f: -q for f, q in order["состав"].items()}
+            if not order.get("филиал"):
+                try:
+                    inventory = load_data()[1]
+                except:
+                    return '', 500
+                if stock_calendar.shortages(order["состав"], None, inventory):
+                    return '', 409
+            try:
+                apply_inventory_deltas(deltas, path=order_stock_path(order), holders=[(lot_key(order), deltas)])
+            except ValueError:
+                return '', 409
+            except:
+                return '', 500
+            journal_order_stock("возврат брони", order, deltas)
+        with changing_order(order):
+            order["статус"] = new_status
+            if restore:
+                order["возвращено"] = False
+                order["истекает"] = None
+        if new_status in SETTLED_STATUSES:
+            lot_store.forget([lot_key(order)])
+    return '', 204
+
+
+@app.route("/orders/status", methods=["POST"])
+def bulk_order_status():
+    # {"ids": [...], "status": "...", "return_stock": true}; возврат цветов по всем
+    # заказам — одна запись на файл склада, результат — по каждому заказу
+    data = request.get_json(silent=True) or {}
+    new_status = data.get("status")
+    ids = data.get("ids") or []
+    return_stock = bool(data.get("return_stock"))
+    if new_status not in ORDER_STATUSES or not isinstance(ids, list) or not ids:
+        return jsonify({"error": "Нужны ids и допустимый status"}), 400
+    if return_stock and new_status != "отменен, не собран":
+        return jsonify({"error": "Вернуть цветы можно только при статусе «отменен, не собран»"}), 400
+
+    results = {}
+    with excel_lock():
+        picked = []
+        for raw in ids:
+            try:
+                oid = int(raw)
+            except (TypeError, ValueError):
+                results[str(raw)] = "некорректный id"
+                continue
+            order = orders_by_id.get(oid)
+            if order is None:
+                results[str(oid)] = "заказ не найден"
+            elif str(oid) not in results:
+                results[str(oid)] = None
+                picked.append(order)
+
+        # движения склада: возврат отменённых и повторное списание снятых броней
+        moves = {}
+        for order in picked:
+            if return_stock and not (order.get("отложено") or order.get("возвращено")):
+                deltas = dict(order["состав"])
+            elif order.get("возвращено") and new_status in CONSUMING_STATUSES:
+                deltas = {f: -q for f, q in order["состав"].items()}
+            else:
+                continue
+            moves.setdefault(order_stock_path(order), []).append((order, deltas))
+
+        failed = set()
+        for path, group in moves.items():
+            total = {}
+            for order, deltas in group:
+                for f, d in deltas.items():
+                    total[f] = total.get(f, 0) + d
+            error = None
+            if path is None:
+                try:
+                    missing = stock_calendar.shortages({f: -d for f, d in total.items() if d < 0}, None, load_data()[1])
+                except Exception:
+                    missing = ["ошибка чтения Excel"]
+                if missing:
+                    error = "Не хватит для предзаказов: " + ", ".join(missing)
+            if error is None:
+                try:
+                    apply_inventory_deltas(total, path=path, holders=[(lot_key(o), d) for o, d in group])
+                except Exception as e:
+                    error = str(e)
+            for order, deltas in group:
+                if error:
+                    failed.add(order["id"])
+                    results[str(order["id"])] = error
+                else:
+                    journal_order_stock("смена статуса", order, deltas)
+
+        moved = {o["id"]: d for group in moves.values() for o, d in group}
+        for order in picked:
+            if order["id"] in failed:
+                continue
+            with changing_order(order):
+                order["статус"] = new_status
+                if order["id"] in moved:
+                    returned = any(d > 0 for d in moved[order["id"]].values())
+                    order["возвращено"] = returned
+                    if not returned:
+                        order["истекает"] = None
+        if new_status in SETTLED_STATUSES:
+            lot_store.forget([lot_key(o) for o in picked if o["id"] not in failed])
+
+    return jsonify({
+        "ok": not any(results.values()),
+        "статус": new_status,
+        "заказы": [{"id": k, "ok": v is None, "ошибка": v} for k, v in results.items()]
+    })
+
+
+# --------- прогноз спроса ----------
+
+class ConsumptionHistory:
+    # расход основного склада по дням из журнала; журнал дочитывается с последней позиции
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.days = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size < self.offset:
+            self.offset, self.days = 0, {}
+        if size == self.offset:
+            return
+        with open(self.path, "rb") as fh:
+            fh.seek(self.offset)
+            for raw in fh:
+                if not raw.endswith(b"\n"):
+                    break
+                self.offset += len(raw)
+                try:
+                    rec = json.loads(raw)
+                except ValueError:
+                    continue
+                if "заказ" not in rec or rec.get("филиал"):
+                    continue
+                day = self.days.setdefault(rec["день"], {})
+                for f, d in rec.get("строки", {}).items():
+                    day[f] = day.get(f, 0) - d
+
+    def items(self):
+        with self.lock:
+            self.refresh()
+            return [(day, f, q) for day, flowers in self.days.items() for f, q in flowers.items()]
+
+
+consumption_history = ConsumptionHistory(JOURNAL_FILE)
+
+
+def daily_consumption(history):
+    # расход по дням: строки — дни (без пропусков до сегодня), колонки — цветы
+    days, flowers, qtys = [], [], []
+    for day, f, q in history.items():
+        if q:
+            days.append(day)
+            flowers.append(f)
+            qtys.append(q)
+    if not days:
+        return pd.DataFrame()
+
+    df = pd.DataFrame({"day": pd.to_datetime(days), "flower": flowers, "qty": qtys})
+    daily = df.pivot_table(index="day", columns="flower", values="qty", aggfunc="sum", fill_value=0)
+    end = max(daily.index.max(), pd.Timestamp(datetime.now().date()))
+    return daily.reindex(pd.date_range(daily.index.min(), end, freq="D"), fill_value=0)
+
+
+def forecast_demand(daily, horizon=1, method="ewm"):
+    # спрос на horizon дней вперёд по каждому цветку
+    if daily.empty:
+        return pd.Series(dtype=float)
+    if method == "seasonal":
+        recent = daily.iloc[-SEASON_WEEKS * 7:]
+        by_weekday = recent.groupby(recent.index.dayofweek).mean()
+        last = daily.index[-1]
+        target = [(last + pd.Timedelta(days=i)).dayofweek for i in range(1, horizon + 1)]
+        return by_weekday.reindex(target, fill_value=0).sum()
+    level = daily.ewm(alpha=FORECAST_ALPHA, adjust=False).mean().iloc[-1]
+    return level * horizon
+
+
+@app.route("/forecast")
+def forecast():
+    try:
+        horizon = max(1, min(int(request.args.get("horizon", 1)), 28))
+    except ValueError:
+        return jsonify({"error": "horizon должен быть числом"}), 400
+    method = request.args.get("method", "ewm")
+    if method not in ("ewm", "seasonal"):
+        return jsonify({"error": "method: ewm или seasonal"}), 400
+
+    try:
+        bouquets, inventory = load_data()
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+
+    demand = forecast_demand(daily_consumption(consumption_history), horizon, method)
+    result = {}
+    for f, q in demand.items():
+        need = math.ceil(q - 1e-9)
+        if need <= 0:
+            continue
+        stock = inventory.get(f, 0)
+        result[f] = {"прогноз": round(float(q), 2), "остаток": stock, "заказать": max(0, need - stock)}
+    return jsonify({
+        "горизонт_дней": horizon,
+        "метод": method,
+        "цветы": result,
+        "закупка": {f: r["заказать"] for f, r in result.items() if r["заказать"] > 0}
+    })
+
+
+# --------- отчёты ----------
+
+def parse_day(value, default):
+    if not value:
+        return default
+    return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+
+
+@app.route("/reports")
+@heavy
+def reports():
+    today = datetime.now().date()
+    try:
+        start = parse_day(request.args.get("from"), (today - timedelta(days=30)).isoformat())
+        end = parse_day(request.args.get("to"), today.isoformat())
+    except ValueError:
+        return jsonify({"error": "Даты в формате ГГГГ-ММ-ДД"}), 400
+    statuses = request.args.getlist("status") or None
+
+    total_orders = 0
+    by_day = {}
+    by_status = {}
+    by_bouquet = {}
+    flowers_total = {}
+    cells = itertools.chain(daily_stats.iter_range(start, end, statuses), order_archive.iter_range(start, end, statuses))
+    for day, status, cell in cells:
+        total_orders += cell["orders"]
+        d = by_day.setdefault(day, {"заказы": 0, "цветы": {}})
+        st = by_status.setdefault(status, {"заказы": 0, "цветы": {}})
+        d["заказы"] += cell["orders"]
+        st["заказы"] += cell["orders"]
+        for name, entry in cell["bouquets"].items():
+            b = by_bouquet.setdefault(name, {"количество": 0, "цветы": {}})
+            b["количество"] += entry["count"]
+            for f, q in entry["flowers"].items():
+                for target in (d["цветы"], st["цветы"], b["цветы"], flowers_total):
+                    target[f] = target.get(f, 0) + q
+
+    return jsonify({
+        "с": start,
+        "по": end,
+        "заказы": total_orders,
+        "цветы": flowers_total,
+        "по_дням": by_day,
+        "по_статусам": by_status,
+        "по_букетам": by_bouquet
+    })
+
+
+# --------- архив заказов ----------
+
+class OrderArchive:
+    # месяц — папка, в ней сжатые npz-куски (один на прогон архивации); внутри куска — колонки:
+    # заказы (id, номер, создан, статус, филиал), строки букетов (заказ, название),
+    # цветы (строка, цветок, кол-во). Читается по куску, вся история в память не поднимается
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, batch):
+        by_month = {}
+        for o in batch:
+            by_month.setdefault(o["создан"][:7], []).append(o)
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        for month, group in by_month.items():
+            line_order, line_name, item_line, item_flower, item_qty = [], [], [], [], []
+            for i, o in enumerate(group):
+                for line in o["букеты"]:
+                    line_order.append(i)
+                    line_name.append(line["название"])
+                    for f, q in line["состав"].items():
+                        item_line.append(len(line_name) - 1)
+                        item_flower.append(f)
+                        item_qty.append(q)
+            cols = {
+                "id": np.array([o["id"] for o in group], dtype=np.int64),
+                "number": np.array([o["номер"] for o in group], dtype=np.int64),
+                "created": np.array([o["создан"] for o in group], dtype=str),
+                "status": np.array([o["статус"] for o in group], dtype=str),
+                "branch": np.array([o.get("филиал") or "" for o in group], dtype=str),
+                "line_order": np.array(line_order, dtype=np.int32),
+                "line_name": np.array(line_name, dtype=str),
+                "item_line": np.array(item_line, dtype=np.int32),
+                "item_flower": np.array(item_flower, dtype=str),
+                "item_qty": np.array(item_qty, dtype=np.int32)
+            }
+            folder = os.path.join(self.path, month)
+            os.makedirs(folder, exist_ok=True)
+            name = f"{stamp}-{os.getpid()}"
+            tmp = os.path.join(folder, name + ".tmp.npz")
+            np.savez_compressed(tmp, **cols)
+            os.replace(tmp, os.path.join(folder, name + ".npz"))
+
+    def chunks(self, start, end):
+        # куски из месяцев, пересекающих [start, end]
+        if not os.path.isdir(self.path):
+            return
+        for month in sorted(os.listdir(self.path)):
+            if month < start[:7] or month > end[:7]:
+                continue
+            folder = os.path.join(self.path, month)
+            for name in sorted(os.listdir(folder)):
+                if name.endswith(".npz") and ".tmp" not in name:
+                    with np.load(os.path.join(folder, name)) as z:
+                        yield {k: z[k] for k in z.files}
+
+    def iter_orders(self, start, end, statuses=None):
+        # заказы в том же виде, что to_dict(), для start <= день создания <= end
+        for cols in self.chunks(start, end):
+            days = cols["created"].astype("U10")
+            mask = (days >= start) & (days <= end)
+            if statuses:
+                mask &= np.isin(cols["status"], list(statuses))
+            if not mask.any():
+                continue
+            lines = [[] for _ in range(len(cols["id"]))]
+            comps = [{} for _ in range(len(cols["line_name"]))]
+            for li, f, q in zip(cols["item_line"].tolist(), cols["item_flower"].tolist(), cols["item_qty"].tolist()):
+                comps[li][f] = q
+            for li, (oi, name) in enumerate(zip(cols["line_order"].tolist(), cols["line_name"].tolist())):
+                lines[oi].append({"название": name, "состав": comps[li]})
+            for i in np.flatnonzero(mask).tolist():
+                total = {}
+                for line in lines[i]:
+                    for f, q in line["состав"].items():
+                        total[f] = total.get(f, 0) + q
+                order = {
+                    "id": int(cols["id"][i]),
+                    "номер": int(cols["number"][i]),
+                    "букеты": lines[i],
+                    "букет": ", ".join(line["название"] for line in lines[i]),
+                    "состав": total,
+                    "статус": str(cols["status"][i]),
+                    "создан": str(cols["created"][i])
+                }
+                if cols["branch"][i]:
+                    order["филиал"] = str(cols["branch"][i])
+                yield order
+
+    def iter_range(self, start, end, statuses=None):
+        # те же (день, статус, ячейка), что DailyStats.iter_range; в памяти — только агрегат
+        # по дням/статусам/букетам, сами заказы читаются потоком
+        stats = DailyStats()
+        for order in self.iter_orders(start, end, statuses):
+            stats.add(order)
+        return stats.iter_range(start, end, statuses)
+
+
+order_archive = OrderArchive(ARCHIVE_DIR)
+
+
+def archive_orders(days=ARCHIVE_AFTER_DAYS):
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+    with excel_lock():
+        old = [o for o in orders if o["статус"] in ARCHIVE_STATUSES and o["создан"] < cutoff and not o.get("отложено")]
+        if not old:
+            return 0
+        order_archive.write([o.to_dict() for o in old])
+        moved = {o["id"] for o in old}
+        orders[:] = [o for o in orders if o["id"] not in moved]
+        for o in old:
+            orders_by_id.pop(o["id"], None)
+            order_removed(o)
+        lot_store.forget([lot_key(o) for o in old])
+    return len(old)
+
+
+@app.route("/orders/archive", methods=["POST"])
+@heavy
+def archive_route():
+    data = request.get_json(silent=True) or {}
+    try:
+        days = max(0, int(data.get("days", ARCHIVE_AFTER_DAYS)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "days должен быть числом"}), 400
+    try:
+        moved = archive_orders(days)
+    except Exception as e:
+        return jsonify({"error": "Ошибка записи архива: " + str(e)}), 500
+    return jsonify({"ok": True, "перенесено": moved, "старше_дней": days})
+
+
+@app.route("/archive/orders")
+@heavy
+def archived_orders():
+    # NDJSON-поток архивных заказов за период
+    today = datetime.now().date()
+    try:
+        start = parse_day(request.args.get("from"), (today - timedelta(days=365)).isoformat())
+        end = parse_day(request.args.get("to"), today.isoformat())
+    except ValueError:
+        return jsonify({"error": "Даты в формате ГГГГ-ММ-ДД"}), 400
+    statuses = request.args.getlist("status") or None
+
+    def generate():
+        for order in order_archive.iter_orders(start, end, statuses):
+            yield json.dumps(order, ensure_ascii=False) + "\n"
+
+    return bulk_response(generate(), "ndjson", "archive")
+
+
+# --------- выгрузка в xlsx ----------
+# книга пишется openpyxl в режиме write-only (строки листа сразу уходят во временный
+# файл) в отдельном потоке; zip книги режется на куски и отдаётся ответом по мере записи
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+XLSX_CHUNK_QUEUE = 16
+
+
+def xlsx_response(title, header, rows, filename):
+    chunks = queue.Queue(maxsize=XLSX_CHUNK_QUEUE)
+    gone = threading.Event()
+
+    def put(item):
+        # если клиент ушёл, куски отбрасываются: прерванный посреди save() zipfile
+        # шумит исключениями при сборке мусора, проще дописать впустую
+        while not gone.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    class Sink:
+        # zipfile пишет в поток без seek (дескрипторы данных после каждого файла)
+        def write(self, data):
+            if data:
+                put(bytes(data))
+            return len(data)
+
+        def flush(self):
+            pass
+
+    def produce():
+        try:
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet(title)
+            ws.append(header)
+            for row in rows:
+                if gone.is_set():
+                    # лист всё равно закрывается, иначе его временный файл шумит при сборке мусора
+                    ws.close()
+                    return
+                ws.append(row)
+            wb.save(Sink())
+        finally:
+            put(None)
+
+    def generate():
+        worker = threading.Thread(target=produce, name="xlsx-export", daemon=True)
+        worker.start()
+        try:
+            # пустой кусок отправляет заголовки: скачивание начинается, пока строки пишутся
+            yield b""
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            gone.set()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=XLSX_MIMETYPE,
+        headers={"Content-Disposition": f"attachment; filename={filename}.xlsx"}
+    )
+
+
+ORDERS_XLSX_HEADER = ["id", "номер", "создан", "статус", "филиал", "выдача", "букет", "состав", "цветов"]
+
+
+def order_xlsx_rows(order):
+    # строка на каждый букет заказа
+    for line in order["букеты"]:
+        comp = line.get("состав") or {}
+        yield [
+            order["id"], order["номер"], order["создан"], order["статус"],
+            order.get("филиал") or "", order.get("выдача") or "", line.get("название") or "",
+            "; ".join(f"{f}: {q}" for f, q in comp.items()), sum(comp.values())
+        ]
+
+
+@app.route("/export/orders")
+@heavy
+def export_orders():
+    # текущие и архивные заказы за период, по дню создания
+    today = datetime.now().date()
+    try:
+        start = parse_day(request.args.get("from"), (today - timedelta(days=365)).isoformat())
+        end = parse_day(request.args.get("to"), today.isoformat())
+    except ValueError:
+        return jsonify({"error": "Даты в формате ГГГГ-ММ-ДД"}), 400
+    statuses = request.args.getlist("status") or None
+    live = list(orders)
+
+    def rows():
+        for order in live:
+            if start <= order["создан"][:10] <= end and (not statuses or order["статус"] in statuses):
+                yield from order_xlsx_rows(order.to_dict())
+        for order in order_archive.iter_orders(start, end, statuses):
+            yield from order_xlsx_rows(order)
+
+    return xlsx_response("Заказы", ORDERS_XLSX_HEADER, rows(), "orders")
+
+
+@app.route("/export/consumption")
+@heavy
+def export_consumption():
+    # расход основного склада по дням и цветам (из журнала)
+    try:
+        start = parse_day(request.args.get("from"), "0000-01-01")
+        end = parse_day(request.args.get("to"), "9999-12-31")
+    except ValueError:
+        return jsonify({"error": "Даты в формате ГГГГ-ММ-ДД"}), 400
+    items = sorted((day, f, q) for day, f, q in consumption_history.items() if q and start <= day <= end)
+    return xlsx_response("Расход", ["день", "цветок", "кол-во"], items, "consumption")
+
+
+# --------- сборочный лист ----------
+
+PICKLIST_HTML = '''
+<!doctype html>
+<title>Сборочный лист</title>
+<meta charset="utf-8">
+<style>
+  body { font-family: Arial, sans-serif; }
+  table { border-collapse: collapse; margin-bottom:20px; }
+  th, td { border: 1px solid #444; padding: 4px 8px; text-align: left; }
+  @media print { a { display:none; } }
+</style>
+<h2>Сборочный лист</h2>
+<p>Статусы: {{ statuses|join(", ") }}; период: {{ start or "…" }} — {{ end if end != "9999-12-31" else "…" }}</p>
+<a href="?{{ query }}&format=csv">Скачать CSV</a>
+
+<h3>По цветам</h3>
+<table>
+  <tr><th>Цветок</th><th>Кол-во</th></tr>
+  {% for f, q in flowers %}
+  <tr><td>{{ f }}</td><td>{{ q }}</td></tr>
+  {% endfor %}
+</table>
+
+<h3>По букетам</h3>
+<table>
+  <tr><th>Букет</th><th>Шт.</th><th>Состав</th></tr>
+  {% for name, entry in bouquets %}
+  <tr>
+    <td>{{ name }}</td>
+    <td>{{ entry["количество"] }}</td>
+    <td>{% for f, q in entry["цветы"].items() %}{{ f }}: {{ q }}<br>{% endfor %}</td>
+  </tr>
+  {% endfor %}
+</table>
+'''
+
+
+def build_picklist(start, end, statuses):
+    bouquets = {}
+    flowers = {}
+    for day, status, cell in daily_stats.iter_range(start, end, statuses):
+        for name, entry in cell["bouquets"].items():
+            b = bouquets.setdefault(name, {"количество": 0, "цветы": {}})
+            b["количество"] += entry["count"]
+            for f, q in entry["flowers"].items():
+                b["цветы"][f] = b["цветы"].get(f, 0) + q
+                flowers[f] = flowers.get(f, 0) + q
+    return bouquets, flowers
+
+
+@app.route("/picklist")
+def picklist():
+    try:
+        start = parse_day(request.args.get("from"), "")
+        end = parse_day(request.args.get("to"), "9999-12-31")
+    except ValueError:
+        return jsonify({"error": "Даты в формате ГГГГ-ММ-ДД"}), 400
+    statuses = request.args.getlist("status") or ["оплачен, не собран"]
+    bouquets, flowers = build_picklist(start, end, statuses)
+    fmt = request.args.get("format", "json")
+
+    if fmt == "csv":
+        def generate():
+            yield csv_line(["букет", "цветок", "кол-во"])
+            for name, entry in sorted(bouquets.items()):
+                for f, q in entry["цветы"].items():
+                    yield csv_line([name, f, q])
+            for f, q in sorted(flowers.items()):
+                yield csv_line(["ИТОГО", f, q])
+        return bulk_response(generate(), "csv", "picklist")
+
+    if fmt == "html":
+        query = urlencode([(k, v) for k, v in request.args.items(multi=True) if k != "format"])
+        return render_template_string(
+            PICKLIST_HTML,
+            statuses=statuses,
+            start=start,
+            end=end,
+            query=query,
+            flowers=sorted(flowers.items()),
+            bouquets=sorted(bouquets.items())
+        )
+
+    return jsonify({"статусы": statuses, "букеты": bouquets, "цветы": flowers})
+
+
+@app.route("/recipes/<int:recipe_id>")
+def recipe_version(recipe_id):
+    if not (0 <= recipe_id < len(recipes_by_id)):
+        return jsonify({"error": "Рецепт не найден"}), 404
+    return jsonify(recipes_by_id[recipe_id].to_dict())
+
+
+# --------- симуляция дня ----------
+
+def read_planned_orders():
+    # JSON {"bouquets": [...]} или CSV «букет[,кол-во]» построчно;
+    # возвращает (названия, ошибки по строкам, всего ошибок)
+    too_many = f"больше {MAX_SIMULATED_ORDERS} заказов"
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        items = data if isinstance(data, list) else data.get("bouquets", [])
+        if len(items) > MAX_SIMULATED_ORDERS:
+            return [], [{"line": MAX_SIMULATED_ORDERS + 1, "error": too_many}], 1
+        return [str(x.get("букет") or x.get("название") or "") if isinstance(x, dict) else str(x) for x in items], [], 0
+
+    names = []
+    errors = []
+    n_errors = 0
+    text = io.TextIOWrapper(io.BufferedReader(request.stream), encoding="utf-8-sig", newline="")
+    reader = csv.reader(text)
+    for row in reader:
+        if not row or not row[0].strip():
+            continue
+        if reader.line_num == 1 and norm(row[0]) == "букет":
+            continue
+        count, err = 1, None
+        if len(row) > 1 and row[1].strip():
+            try:
+                count = int(row[1])
+            except ValueError:
+                err = f"некорректное количество: {row[1]}"
+            else:
+                if count < 0:
+                    err = f"отрицательное количество: {row[1]}"
+        if err is None and len(names) + count > MAX_SIMULATED_ORDERS:
+            n_errors += 1
+            errors.append({"line": reader.line_num, "error": too_many})
+            break
+        if err:
+            n_errors += 1
+            if len(errors) < MAX_BULK_ERRORS:
+                errors.append({"line": reader.line_num, "error": err})
+            continue
+        names.extend([row[0]] * count)
+    return names, errors, n_errors
+
+
+def simulate_orders(names, bouquets, inventory):
+    # накопленный расход по каждому цветку в порядке заказов (cumsum по группам цветков)
+    recipe_names = list(bouquets)
+    recipe_index = {n: i for i, n in enumerate(recipe_names)}
+    flowers = sorted({f for comp in bouquets.values() for f in comp} | set(inventory))
+    flower_index = {f: i for i, f in enumerate(flowers)}
+
+    lens = np.array([len(bouquets[n]) for n in recipe_names], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lens)[:-1])) if len(lens) else np.zeros(0, dtype=np.int64)
+    rec_flower = np.array([flower_index[f] for n in recipe_names for f in bouquets[n]], dtype=np.int64)
+    rec_qty = np.array([q for n in recipe_names for q in bouquets[n].values()], dtype=np.int64)
+    stock = np.array([inventory.get(f, 0) for f in flowers], dtype=np.int64)
+
+    keys = [norm(n) for n in names]
+    unknown = [i for i, k in enumerate(keys) if k not in recipe_index]
+    plan = np.array([recipe_index.get(k, -1) for k in keys], dtype=np.int64)
+    positions = np.flatnonzero(plan >= 0)
+    plan = plan[positions]
+
+    # разворачиваем заказы в пары (позиция, цветок, кол-во)
+    n_items = lens[plan]
+    order_pos = np.repeat(positions, n_items)
+    offsets = np.arange(n_items.sum()) - np.repeat(np.cumsum(n_items) - n_items, n_items)
+    src = np.repeat(starts[plan], n_items) + offsets
+    item_flower = rec_flower[src]
+    item_qty = rec_qty[src]
+
+    order = np.argsort(item_flower, kind="stable")
+    f_sorted = item_flower[order]
+    pos_sorted = order_pos[order]
+    cum = np.cumsum(item_qty[order])
+    group_start = np.flatnonzero(np.r_[True, f_sorted[1:] != f_sorted[:-1]]) if len(f_sorted) else np.zeros(0, dtype=np.int64)
+    group_sizes = np.diff(np.r_[group_start, len(f_sorted)])
+    cum -= np.repeat(np.r_[0, cum[group_start[1:] - 1]] if len(group_start) else np.zeros(0, dtype=np.int64), group_sizes)
+
+    failing = cum > stock[f_sorted]
+    fail_flowers, first = np.unique(f_sorted[failing], return_index=True)
+    first_pos = pos_sorted[failing][first]
+
+    need = np.bincount(item_flower, weights=item_qty, minlength=len(flowers)).astype(np.int64)
+    shortfall = np.maximum(need - stock, 0)
+
+    result = {}
+    for f_idx in np.flatnonzero(need):
+        result[flowers[f_idx]] = {"нужно": int(need[f_idx]), "есть": int(stock[f_idx]), "не_хватит": int(shortfall[f_idx])}
+    for f_idx, pos in zip(fail_flowers, first_pos):
+        result[flowers[f_idx]]["первый_срыв"] = {"позиция": int(pos) + 1, "букет": names[pos]}
+
+    first_fail = None
+    if len(first_pos):
+        pos = int(first_pos.min())
+        first_fail = {"позиция": pos + 1, "букет": names[pos]}
+    return {
+        "заказов": len(names),
+        "неизвестные": [{"позиция": i + 1, "букет": names[i]} for i in unknown[:MAX_BULK_ERRORS]],
+        "первый_срыв": first_fail,
+        "цветы": result
+    }
+
+
+# --------- похожие собираемые букеты ----------
+
+class RecipeMatrix:
+    # рецепты строками по id цветов реестра: количества — для проверки сборки,
+    # нормированные по длине строки — для косинусной близости
+
+    def __init__(self, bouquets, registry):
+        self.names = list(bouquets)
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.qty = np.zeros((len(self.names), len(registry)), dtype=np.int32)
+        for r, n in enumerate(self.names):
+            for f, q in bouquets[n].items():
+                i = registry.id(f)
+                if i is not None:
+                    self.qty[r, i] = q
+        lengths = np.linalg.norm(self.qty, axis=1)
+        lengths[lengths == 0] = 1
+        self.unit = (self.qty / lengths[:, None]).astype(np.float32)
+        self.nonempty = self.qty.any(axis=1)
+
+    def nearest(self, row, stock, k, chunk=256):
+        # k ближайших к рецепту row среди тех, что собираются из stock: [(строка, близость)];
+        # сборка проверяется пачками по убыванию близости, пока не наберётся k
+        sim = self.unit @ self.unit[row]
+        sim[row] = -np.inf
+        sim[~self.nonempty] = -np.inf
+        ranked = np.argsort(-sim, kind="stable")
+        found = []
+        for start in range(0, len(ranked), chunk):
+            rows = ranked[start:start + chunk]
+            rows = rows[np.isfinite(sim[rows])]
+            ok = rows[(self.qty[rows] <= stock).all(axis=1)]
+            found.extend((int(i), float(sim[i])) for i in ok[:k - len(found)])
+            if len(found) >= k or len(rows) < chunk:
+                break
+        return found
+
+
+def read_recipe_matrix(path):
+    bouquets = load_data(path)[0]
+    return RecipeMatrix(bouquets, flower_registry(path))
+
+
+# матрица пересобирается при смене версии книги (рецепты и склад в одном файле)
+recipe_matrix_cache = SingleFlightCache(read_recipe_matrix)
+
+
+@app.route("/recommend")
+def recommend():
+    name = request.args.get("bouquet", "")
+    try:
+        k = min(max(1, int(request.args.get("k", RECOMMEND_DEFAULT))), RECOMMEND_MAX)
+    except ValueError:
+        return jsonify({"error": "k должен быть числом"}), 400
+    branch = parse_branch(request.args.get("branch"))
+    if branch is False:
+        return jsonify({"error": "Неизвестный филиал"}), 404
+    try:
+        matrix = recipe_matrix_cache.get(EXCEL_FILE, stock_version())
+        bouquets, inventory = load_branch_data(branch)
+        registry = flower_registry(EXCEL_FILE)
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+
+    row = matrix.index.get(norm(name))
+    if row is None:
+        return jsonify({"error": "Такого букета нет в базе"}), 404
+    result = check_order_with_data(name, bouquets, inventory)
+    similar = []
+    for i, sim in matrix.nearest(row, registry.vector(inventory), k):
+        recipe = bouquets.get(matrix.names[i])
+        if recipe is None:
+            continue
+        similar.append({
+            "букет": matrix.names[i],
+            "близость": round(sim, 4),
+            "можно_собрать": buildable_count(recipe, inventory),
+            "состав": recipe
+        })
+    return jsonify({"букет": name, "статус": result["статус"], "сообщение": result["сообщение"], "похожие": similar})
+
+
+@app.route("/simulate", methods=["POST"])
+@heavy
+def simulate():
+    names, errors, n_errors = read_planned_orders()
+    if n_errors:
+        return jsonify({"error": "План не принят: есть ошибки", "errors": errors, "errors_total": n_errors}), 400
+    if not names:
+        return jsonify({"error": "Пустой список букетов"}), 400
+    try:
+        bouquets, inventory = load_data()
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+    return jsonify(simulate_orders(names, bouquets, inventory))
+
+
+# --------- поиск заказов ----------
+
+@app.route("/orders/search")
+def orders_search():
+    args = request.args
+    start = args.get("from") or None
+    end = args.get("to") or None
+    if end and len(end) == 10:
+        end += "T23:59:59\uffff"
+    try:
+        page = max(1, int(args.get("page", 1)))
+        per_page = max(1, min(int(args.get("per_page", 50)), 200))
+    except ValueError:
+        return jsonify({"error": "page и per_page должны быть числами"}), 400
+
+    ids = order_index.search(
+        number=args.get("number"),
+        bouquet=args.get("bouquet"),
+        flower=args.get("flower"),
+        status=args.get("status"),
+        start=start,
+        end=end
+    )
+    page_ids = ids[(page - 1) * per_page: page * per_page]
+    return jsonify({
+        "всего": len(ids),
+        "страница": page,
+        "на_странице": per_page,
+        "заказы": [orders_by_id[oid].to_dict() for oid in page_ids]
+    })
+
+
+# --------- календарь остатков ----------
+
+def parse_pickup(value):
+    # None — без даты выдачи, False — ошибка формата или время за горизонтом
+    if not value:
+        return None
+    try:
+        pickup = datetime.fromisoformat(value).replace(second=0, microsecond=0)
+    except ValueError:
+        return False
+    if pickup <= datetime.now() or not stock_calendar.in_horizon(pickup.isoformat()):
+        return False
+    return pickup.isoformat(timespec="seconds")
+
+
+@app.route("/deliveries/expected", methods=["GET"])
+def expected_deliveries_list():
+    now = datetime.now().isoformat(timespec="seconds")
+    with excel_lock():
+        return jsonify([dict(d) for d in expected_deliveries if d["время"] >= now])
+
+
+@app.route("/deliveries/expected", methods=["POST"])
+def expected_delivery_add():
+    data = request.get_json(silent=True) or {}
+    when = parse_pickup(data.get("at"))
+    if not when:
+        return jsonify({"error": "Некорректное или прошедшее время поставки"}), 400
+    try:
+        known = flower_registry()
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+
+    added = []
+    for line in data.get("lines") or []:
+        flower, qty, err = parse_stock_record(line, known) if isinstance(line, dict) else (None, None, "ожидался объект")
+        if err or qty <= 0:
+            return jsonify({"error": err or "количество должно быть больше нуля"}), 400
+        added.append({"цветок": flower, "кол-во": qty, "время": when})
+    # список меняет и приёмка (/receive) — под той же блокировкой
+    with excel_lock():
+        for d in added:
+            expected_deliveries.append(d)
+            stock_calendar.add_delivery(d["цветок"], d["кол-во"], when)
+    return jsonify({"ok": True, "поставки": added}), 201
+
+
+@app.route("/projection")
+def projection():
+    try:
+        bouquets, inventory = load_data()
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+    at = request.args.get("at")
+    when = parse_pickup(at) if at else None
+    if when is False:
+        return jsonify({"error": "Некорректное время или дальше горизонта"}), 400
+
+    name = request.args.get("bouquet")
+    if name:
+        recipe = bouquets.get(norm(name))
+        if recipe is None:
+            return jsonify({"error": "Такого букета нет в базе"}), 404
+        missing = stock_calendar.shortages(recipe, when, inventory)
+        return jsonify({"букет": name, "время": when, "можно": not missing, "недостаточно": missing})
+
+    flower = request.args.get("flower")
+    if flower:
+        stock_calendar.refresh()
+        row = stock_calendar.rows.get(flower)
+        step = timedelta(minutes=PROJECTION_BUCKET_MINUTES)
+        base = datetime.fromtimestamp(stock_calendar.base)
+        series = stock_calendar.prefix[row] if row is not None else np.zeros(stock_calendar.size(), dtype=np.int64)
+        stock = inventory.get(flower, 0)
+        points = {}
+        prev = None
+        for i, v in enumerate(series):
+            if v != prev:
+                points[(base + i * step).isoformat(timespec="minutes")] = stock + int(v)
+                prev = v
+        return jsonify({"цветок": flower, "остатки": points})
+
+    return jsonify({f: inventory.get(f, 0) + stock_calendar.lowest(f, when) for f in inventory})
+
+
+# --------- филиалы ----------
+
+def branch_file(branch):
+    return os.path.join(BRANCHES_DIR, f"{branch}.xlsx")
+
+
+def parse_branch(value):
+    # None — основной склад, False — неизвестный филиал
+    if not value or value == MAIN_BRANCH:
+        return None
+    return value if value in list_branches() else False
+
+
+def order_stock_path(order):
+    # файл склада, с которого списан заказ
+    return branch_file(order["филиал"]) if order.get("филиал") else None
+
+
+def list_branches():
+    names = [MAIN_BRANCH]
+    if os.path.isdir(BRANCHES_DIR):
+        names += sorted(f[:-5] for f in os.listdir(BRANCHES_DIR) if f.endswith(".xlsx") and ".tmp" not in f)
+    return names
+
+
+def load_branch_data(branch=None):
+    # рецепты общие, склад — из файла филиала
+    bouquets, inventory = load_data()
+    if branch and branch != MAIN_BRANCH:
+        inventory = load_data(branch_file(branch))[1]
+    return bouquets, inventory
+
+
+def buildable_count(recipe, inventory):
+    return min(inventory.get(f, 0) // q for f, q in recipe.items()) if recipe else 0
+
+
+@app.route("/branches", methods=["GET"])
+def branches():
+    return jsonify({"филиалы": list_branches()})
+
+
+@app.route("/branches", methods=["POST"])
+def create_branch():
+    data = request.get_json(silent=True) or {}
+    name = str(data.get("name") or "").strip()
+    if not re.fullmatch(r"[\w\- ]{1,50}", name) or name in list_branches():
+        return jsonify({"error": "Некорректное или занятое имя филиала"}), 400
+    try:
+        df, name_col, flower_cols, sklad_row = read_frame()
+    except Exception as e:
+        return jsonify({"error": "Ошибка чтения Excel: " + str(e)}), 500
+
+    # шард филиала: те же колонки цветов и одна строка «склад» с нулями
+    shard = pd.DataFrame([["склад"] + [0] * len(flower_cols)], columns=df.columns)
+    os.makedirs(BRANCHES_DIR, exist_ok=True)
+    with excel_lock():
+        write_frame(shard, branch_file(name))
+    return jsonify({"ok": True, "филиал": name}), 201
+
+
+@app.route("/branches/<branch>/orders")
+def branch_orders_list(branch):
+    branch = parse_branch(branch)
+    if branch is False:
+        return jsonify({"error": "Неизвестный филиал"}), 404
+    return jsonify([o.to_dict() for o in orders if o.get("филиал") == branch])
+
+
+@app.route("/availability")
+def availability():
+    name = request.args.get("bouquet", "")
+    try:
+        bouquets, inventory = load_data()
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+    recipe = bouquets.get(norm(name))
+    if recipe is None:
+        return jsonify({"error": "Такого букета нет в базе"}), 404
+
+    result = {MAIN_BRANCH: buildable_count(recipe, inventory)}
+    for branch in list_branches()[1:]:
+        try:
+            result[branch] = buildable_count(recipe, load_data(branch_file(branch))[1])
+        except Exception:
+            result[branch] = None
+    ranked = sorted((b for b in result if result[b]), key=lambda b: -result[b])
+    return jsonify({"букет": name, "состав": recipe, "филиалы": result, "можно_собрать": ranked})
+
+
+# --------- API каталога ----------
+# только чтение; ETag считается из версии файлов склада (stat), поэтому ответ 304
+# отдаётся без разбора книги
+
+CATALOG_RECIPE_FIELDS = {
+    "букет": lambda name, recipe, inventory: name,
+    "состав": lambda name, recipe, inventory: recipe,
+    "можно_собрать": lambda name, recipe, inventory: buildable_count(recipe, inventory),
+}
+CATALOG_STOCK_FIELDS = {
+    "цветок": lambda flower, qty: flower,
+    "остаток": lambda flower, qty: qty,
+}
+
+
+def catalog_args(allowed):
+    # (offset, limit, поля) из запроса; ValueError с текстом для клиента
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", CATALOG_PAGE_DEFAULT))
+    except ValueError:
+        raise ValueError("offset и limit должны быть числами")
+    if offset < 0 or not 1 <= limit <= CATALOG_PAGE_MAX:
+        raise ValueError(f"offset >= 0, limit от 1 до {CATALOG_PAGE_MAX}")
+    fields = [f.strip() for f in request.args.get("fields", "").split(",") if f.strip()] or list(allowed)
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError("Неизвестные поля: " + ", ".join(unknown) + "; есть: " + ", ".join(allowed))
+    return offset, limit, fields
+
+
+def catalog_etag(version):
+    # версия склада + путь + параметры: у каждой страницы и набора полей свой ETag
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return hashlib.sha1(f"{version}|{request.path}|{query}".encode()).hexdigest()
+
+
+def catalog_not_modified(etag):
+    tags = request.if_none_match
+    return any(tags.contains(tag) for tag in (etag, f"{etag}-gzip", f"{etag}-br"))
+
+
+def catalog_response(payload, etag):
+    if payload is None:
+        resp = Response(status=304)
+    else:
+        resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+@app.route("/api/catalog/recipes")
+def api_catalog_recipes():
+    branch = parse_branch(request.args.get("branch"))
+    if branch is False:
+        return jsonify({"error": "Неизвестный филиал"}), 404
+    try:
+        offset, limit, fields = catalog_args(CATALOG_RECIPE_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    version = check_stock_version(branch)
+    etag = catalog_etag(version)
+    if catalog_not_modified(etag):
+        return catalog_response(None, etag)
+    try:
+        bouquets, inventory = load_branch_data(branch)
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
+
+    names = sorted(bouquets)
+    items = [
+        {f: CATALOG_RECIPE_FIELDS[f](name, bouquets[name], inventory) for f in fields}
+        for name in names[offset:offset + limit]
     ]
+    return catalog_response({"версия": version, "всего": len(names), "offset": offset, "limit": limit, "элементы": items}, etag)
 
-    if new_status not in allowed:
-        return '', 400
 
-    if not (0 <= index < len(orders)):
-        return '', 400
+@app.route("/api/catalog/stock")
+def api_catalog_stock():
+    branch = parse_branch(request.args.get("branch"))
+    if branch is False:
+        return jsonify({"error": "Неизвестный филиал"}), 404
+    try:
+        offset, limit, fields = catalog_args(CATALOG_STOCK_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    version = check_stock_version(branch)
+    etag = catalog_etag(version)
+    if catalog_not_modified(etag):
+        return catalog_response(None, etag)
+    try:
+        inventory = load_branch_data(branch)[1]
+    except Exception:
+        return jsonify({"error": "Ошибка чтения Excel"}), 500
 
-    orders[index]["статус"] = new_status
-    return '', 204
+    flowers = sorted(inventory)
+    items = [
+        {f: CATALOG_STOCK_FIELDS[f](flower, inventory[flower]) for f in fields}
+        for flower in flowers[offset:offset + limit]
+    ]
+    return catalog_response({"версия": version, "всего": len(flowers), "offset": offset, "limit": limit, "элементы": items}, etag)
 
 
 # диагностический маршрут
@@ -1330,6 +4714,7 @@ def book_with_replacement():
     recipe = bouquets[norm(name)].copy()
 
     
+    added = {}
     for repl in replacements:
         rf = repl.get('flower')
         try:
@@ -1337,7 +4722,13 @@ def book_with_replacement():
         except:
             rq = 0
         if rq > 0:
-            recipe[rf] = recipe.get(rf, 0) + rq
+            added[rf] = added.get(rf, 0) + rq
+    # замены вводятся вручную: «роза» должна стать колонкой книги, а не новым цветком
+    added, unknown = flower_registry().resolve(added)
+    if unknown:
+        return jsonify({"error": "Неизвестные цветы: " + ", ".join(unknown)}), 400
+    for rf, rq in added.items():
+        recipe[rf] = recipe.get(rf, 0) + rq
 
     
     return jsonify({